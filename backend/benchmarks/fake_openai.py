@@ -0,0 +1,144 @@
+"""Local OpenAI-compatible stand-in for benchmarks.
+
+Implements ``POST /v1/chat/completions`` (plain and ``stream=True``) with a
+configurable latency distribution, per-token streaming delay and error
+injection. Run standalone with::
+
+    python -m backend.benchmarks.fake_openai --port 9100
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY_TOKENS = ["ふふ", "、", "こんにちは", "。", "今日", "は", "いい", "天気", "だね", "。"]
+
+
+@dataclass
+class FakeSettings:
+    latency_median: float = 0.4     # 応答開始までの遅延の中央値（秒）
+    latency_sigma: float = 0.5      # 対数正規分布のσ
+    token_delay: float = 0.02       # ストリーミング時のトークン間隔（秒）
+    error_rate: float = 0.0         # エラーを返す確率
+    rate_limit_share: float = 0.5   # エラーのうち 429 にする割合（残りは 500）
+
+    def sample_latency(self) -> float:
+        if self.latency_median <= 0:
+            return 0.0
+        return random.lognormvariate(0, self.latency_sigma) * self.latency_median
+
+
+def _content_for(messages: list) -> str:
+    system = messages[0]["content"] if messages else ""
+    if '"score"' in system:
+        return json.dumps({"score": random.randint(-3, 3), "reason": "ベンチマーク"}, ensure_ascii=False)
+    if "意図" in system and "抽出" in system:
+        return "ユーザーは雑談をしたい。"
+    if "要約" in system:
+        return "ユーザーとキャラクターは雑談を続けている。"
+    return "".join(REPLY_TOKENS)
+
+
+def create_fake_app(settings: FakeSettings) -> FastAPI:
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        app.state.requests += 1
+        body = await request.json()
+        await asyncio.sleep(settings.sample_latency())
+
+        if random.random() < settings.error_rate:
+            if random.random() < settings.rate_limit_share:
+                return JSONResponse(
+                    {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                    status_code=429,
+                    headers={"Retry-After": "1"},
+                )
+            return JSONResponse({"error": {"message": "Internal error", "type": "server_error"}}, status_code=500)
+
+        model = body.get("model", "gpt-4o")
+        content = _content_for(body.get("messages", []))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", []))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content),
+            "total_tokens": prompt_tokens + len(content),
+        }
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        tokens = REPLY_TOKENS if content == "".join(REPLY_TOKENS) else [content]
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        async def events():
+            def chunk(delta, finish_reason=None, chunk_usage=None, choices=True):
+                payload = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if choices else [],
+                }
+                if chunk_usage:
+                    payload["usage"] = chunk_usage
+                return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+            yield chunk({"role": "assistant", "content": ""})
+            for token in tokens:
+                await asyncio.sleep(settings.token_delay)
+                yield chunk({"content": token})
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield chunk(None, chunk_usage=usage, choices=False)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-median", type=float, default=0.4)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings = FakeSettings(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        token_delay=args.token_delay,
+        error_rate=args.error_rate,
+    )
+    uvicorn.run(create_fake_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""Offline load test: the FastAPI app against a fake OpenAI server and a local DB.
+
+Starts ``fake_openai`` on a local port, points the app at it through
+``OPENAI_BASE_URL``, seeds a local database and drives a mixed workload
+in-process at a fixed concurrency. Reports p50/p95/p99 latency,
+requests/sec and SQL statements per request for each endpoint::
+
+    python -m backend.benchmarks.load_test --concurrency 50 --requests 2000 \\
+        --mix chat=4,evaluate=3,history=2,import=1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+# 計測中のエンドポイント名（SQL 実行回数の集計に使用）
+_current_endpoint: ContextVar[str] = ContextVar("current_endpoint", default="setup")
+
+SHORT_MESSAGES = ["こんにちは", "ありがとう", "うん", "はい", "おはよう", "またね", "1", "2", "3"]
+LONG_MESSAGES = [
+    "今日は森の奥で不思議な光を見たんだけど、あれは何だったと思う？",
+    "君の故郷の話をもう少し聞かせてほしいな。",
+    "昨日は約束を守れなくてごめん。怒ってる？",
+    "この街で一番おいしい料理を教えてくれない？",
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_fake_openai(settings, port: int):
+    import uvicorn
+
+    from backend.benchmarks.fake_openai import create_fake_app
+
+    server = uvicorn.Server(uvicorn.Config(
+        create_fake_app(settings), host="127.0.0.1", port=port, log_level="warning"
+    ))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def _parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _seed(n_users: int, n_constructs: int):
+    from backend.db.database import SessionLocal, get_engine
+    from backend.models.models import Base, Character, Construct, User
+
+    engine = get_engine()
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        character = Character(
+            name="ベンチ",
+            personality="穏やか",
+            system_prompt="あなたはベンチです。",
+            background="森の図書館の司書。",
+            world="魔法のある世界。",
+            tone="丁寧語",
+            prohibited=["現実世界の話をしない"],
+            examples=[{"user": "こんにちは", "assistant": "いらっしゃいませ。"}],
+        )
+        users = [User(username=f"bench-{i}") for i in range(n_users)]
+        db.add(character)
+        db.add_all(users)
+        db.flush()
+        for user in users:
+            for i in range(n_constructs):
+                db.add(Construct(
+                    user_id=user.id,
+                    character_id=character.id,
+                    axis=["慎重", "大胆"],
+                    name=f"価値軸{i}",
+                    importance=i % 5,
+                    behavior_effect="値が高いほど大胆に振る舞う。",
+                    value=i % 3,
+                ))
+        db.commit()
+        return [str(u.id) for u in users], str(character.id)
+
+
+def _import_payload(user_id: str, character_id: str, lines: int) -> bytes:
+    return "\n".join(
+        json.dumps({
+            "user_id": user_id,
+            "character_id": character_id,
+            "axis": ["内向", "外向"],
+            "name": f"import-{i}",
+            "importance": i % 5,
+            "behavior_effect": "ベンチマーク用",
+            "value": i % 5 - 2,
+        }, ensure_ascii=False)
+        for i in range(lines)
+    ).encode("utf-8")
+
+
+async def _run(args) -> dict:
+    import httpx
+    from sqlalchemy import event
+
+    from backend.db.database import get_engine
+    from backend.main import create_app
+
+    user_ids, character_id = _seed(args.users, args.constructs)
+    engine = get_engine()
+
+    query_counts = defaultdict(int)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        query_counts[_current_endpoint.get()] += 1
+
+    def message() -> str:
+        return random.choice(SHORT_MESSAGES if random.random() < args.short_ratio else LONG_MESSAGES)
+
+    def build_request(name: str):
+        user_id = random.choice(user_ids)
+        if name == "chat":
+            return "POST", "/chat", {"json": {"user_id": user_id, "character_id": character_id, "user_message": message()}}
+        if name == "stream":
+            return "POST", "/chat/stream", {"json": {"user_id": user_id, "character_id": character_id, "user_message": message()}}
+        if name == "turn":
+            return "POST", "/turn", {"json": {"user_id": user_id, "character_id": character_id, "user_message": message()}}
+        if name == "evaluate":
+            return "POST", "/evaluate-liking", {"json": {"user_id": user_id, "character_id": character_id, "player_message": message()}}
+        if name == "history":
+            return "GET", f"/history/{user_id}/{character_id}", {"params": {"limit": 50}}
+        if name == "import":
+            payload = _import_payload(user_id, character_id, args.import_lines)
+            return "POST", "/constructs/import", {"files": {"file": ("bench.jsonl", payload)}}
+        raise ValueError(f"unknown workload: {name}")
+
+    mix = _parse_mix(args.mix)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    remaining = args.requests
+
+    app = create_app()
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as http:
+
+            async def worker():
+                nonlocal remaining
+                while remaining > 0:
+                    remaining -= 1
+                    name = random.choices(names, weights)[0]
+                    method, path, kwargs = build_request(name)
+                    token = _current_endpoint.set(name)
+                    start = time.perf_counter()
+                    try:
+                        response = await http.request(method, path, **kwargs)
+                        if (
+                            response.status_code >= 400
+                            or "エラーが発生しました" in response.text[:200]
+                            or (name == "stream" and "event: done" not in response.text)
+                        ):
+                            errors[name] += 1
+                    except Exception:
+                        errors[name] += 1
+                    finally:
+                        latencies[name].append(time.perf_counter() - start)
+                        _current_endpoint.reset(token)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+
+    report = {"elapsed": elapsed, "total_rps": sum(len(v) for v in latencies.values()) / elapsed, "endpoints": {}}
+    for name in names:
+        values = sorted(latencies[name])
+        if not values:
+            continue
+        report["endpoints"][name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "rps": len(values) / elapsed,
+            "p50_ms": _percentile(values, 0.50) * 1000,
+            "p95_ms": _percentile(values, 0.95) * 1000,
+            "p99_ms": _percentile(values, 0.99) * 1000,
+            "db_queries_per_request": query_counts[name] / len(values),
+        }
+    return report
+
+
+def _print_report(report: dict) -> None:
+    print(f"elapsed {report['elapsed']:.2f}s, {report['total_rps']:.1f} req/s overall")
+    print(f"{'endpoint':<10}{'reqs':>7}{'errs':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+    for name, row in report["endpoints"].items():
+        print(
+            f"{name:<10}{row['requests']:>7}{row['errors']:>6}{row['rps']:>9.1f}"
+            f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['db_queries_per_request']:>9.1f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--mix", default="chat=4,evaluate=3,history=2,import=1",
+                        help="comma separated name=weight; names: chat, stream, turn, evaluate, history, import")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--constructs", type=int, default=10, help="constructs seeded per user")
+    parser.add_argument("--import-lines", type=int, default=200)
+    parser.add_argument("--short-ratio", type=float, default=0.6, help="share of short, repeated messages")
+    parser.add_argument("--database-url", default=None,
+                        help="defaults to a fresh SQLite file in a temp directory; the DB is reset")
+    parser.add_argument("--latency-median", type=float, default=0.4)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    from backend.benchmarks.fake_openai import FakeSettings
+
+    port = _free_port()
+    _start_fake_openai(FakeSettings(
+        latency_median=args.latency_median,
+        latency_sigma=args.latency_sigma,
+        token_delay=args.token_delay,
+        error_rate=args.error_rate,
+    ), port)
+
+    # backend.main を import する前に接続先を差し替える
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    os.environ["OPENAI_API_KEY"] = "sk-bench"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+
+    report = asyncio.run(_run(args))
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        _print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Micro-benchmark: legacy build_full_prompt vs. the compiled-prefix version.
+
+Run from the repository root::
+
+    python -m backend.benchmarks.prompt_assembly
+"""
+import argparse
+import json
+import timeit
+import uuid
+from types import SimpleNamespace
+from typing import Optional
+
+from backend.services.prompts import LIKING_LEVEL_PROMPTS, build_full_prompt, prompt_cache
+
+
+def legacy_build_full_prompt(character, liking_level: int, constructs=None, intent: Optional[str] = None) -> str:
+    """Prompt assembly as it was before the compiled-prefix cache."""
+    prohibited_text = "\n".join(f"- {item}" for item in json.loads(character.prohibited)) if character.prohibited else "なし"
+    examples_text = "\n".join(
+        f"ユーザー: {ex['user']}\nキャラ: {ex['assistant']}"
+        for ex in json.loads(character.examples)
+    ) if character.examples else "なし"
+    liking_text = LIKING_LEVEL_PROMPTS.get(liking_level, "")
+    intent_text = f"\n【ユーザーの意図】\n{intent}" if intent else ""
+    def format_construct(c):
+        axis = json.loads(c.axis) if isinstance(c.axis, str) else c.axis
+        pair = f"{axis[0]} ↔ {axis[1]}" if len(axis) == 2 else ",".join(axis)
+        return f"- {c.name} ({pair}) = {c.value} / importance {c.importance}\n  {c.behavior_effect}"
+
+    constructs_text = "\n".join(format_construct(c) for c in constructs) if constructs else "なし"
+
+    return f"""あなたは「{character.name}」というキャラクターとして対話を行います。
+
+このキャラクターの性格は Big Five モデルに基づき、以下の通り数値で表されています。
+スコアは 0.0（非常に低い）〜 1.0（非常に高い）の範囲です。
+
+- Openness: {character.openness}
+- Conscientiousness: {character.conscientiousness}
+- Extraversion: {character.extraversion}
+- Agreeableness: {character.agreeableness}
+- Neuroticism: {character.neuroticism}
+
+これらの性格特性に基づき、発言内容・話し方・反応を自然に調整してください。
+
+【背景】
+{character.background}
+
+【世界観】
+{character.world}
+
+【口調】
+{character.tone}
+
+【禁止事項】
+{prohibited_text}
+
+【会話例】
+{examples_text}
+
+【価値軸】
+{constructs_text}
+
+{liking_text}{intent_text}
+"""
+
+
+def make_character(n_examples: int) -> SimpleNamespace:
+    return SimpleNamespace(
+        id=uuid.uuid4(),
+        name="アリス",
+        openness=0.7,
+        conscientiousness=0.4,
+        extraversion=0.6,
+        agreeableness=0.8,
+        neuroticism=0.3,
+        background="古代遺跡で目覚めた記憶喪失のAI。" * 5,
+        world="魔法と機械が共存する世界。" * 5,
+        tone="丁寧語",
+        prohibited=json.dumps([f"禁止事項{i}" for i in range(10)], ensure_ascii=False),
+        examples=json.dumps(
+            [{"user": f"質問{i}", "assistant": f"回答{i}です。"} for i in range(n_examples)],
+            ensure_ascii=False,
+        ),
+    )
+
+
+def make_constructs(n: int) -> list:
+    return [
+        SimpleNamespace(
+            name=f"価値軸{i}",
+            axis=json.dumps(["慎重", "大胆"], ensure_ascii=False),
+            value=i % 5,
+            importance=i % 3,
+            behavior_effect="値が高いほど大胆に振る舞う。",
+        )
+        for i in range(n)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--examples", type=int, default=20)
+    parser.add_argument("--constructs", type=int, default=10)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    character = make_character(args.examples)
+    constructs = make_constructs(args.constructs)
+    legacy_args = (character, 3, constructs, "挨拶をしている")
+    # 現行のモデルは JSON 列をデコード済みの値で持つ
+    native_character = SimpleNamespace(**{
+        **vars(character),
+        "prohibited": json.loads(character.prohibited),
+        "examples": json.loads(character.examples),
+    })
+    native_constructs = [SimpleNamespace(**{**vars(c), "axis": json.loads(c.axis)}) for c in constructs]
+    call_args = (native_character, 3, native_constructs, "挨拶をしている")
+
+    legacy = legacy_build_full_prompt(*legacy_args)
+    compiled = build_full_prompt(*call_args)
+    assert legacy == compiled, "compiled prompt differs from legacy output"
+
+    prompt_cache.invalidate()
+    legacy_s = min(timeit.repeat(lambda: legacy_build_full_prompt(*legacy_args), number=args.number, repeat=3))
+    compiled_s = min(timeit.repeat(lambda: build_full_prompt(*call_args), number=args.number, repeat=3))
+
+    per_legacy = legacy_s / args.number * 1e6
+    per_compiled = compiled_s / args.number * 1e6
+    print(f"prompt length : {len(compiled)} chars")
+    print(f"legacy        : {per_legacy:8.2f} µs/call")
+    print(f"compiled      : {per_compiled:8.2f} µs/call")
+    print(f"speedup       : {per_legacy / per_compiled:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,9 @@ from pathlib import Path
 env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
-from backend.db.database import engine
+from backend.db.database import get_engine
 from backend.models.models import Base
 
 print("🔧 テーブルを作成中...")
-Base.metadata.create_all(bind=engine)
+Base.metadata.create_all(bind=get_engine())
 print("✅ テーブル作成完了！")
@@ -1,11 +1,17 @@
-import json
-from typing import List, Optional
+import base64
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+from sqlalchemy import Float, Text, case, cast, func, insert, literal, select, text, tuple_, type_coerce
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
-from backend.models.models import Character, Construct
+from backend.models.models import (
+    CacheVersion, Character, ChatHistory, Construct, InternalState, LLMUsageHourly, User,
+)
 from backend.schemas.schemas import CharacterCreate, ConstructCreate
 
 # 🔸 キャラ新規作成
-def create_character(db: Session, character: CharacterCreate) -> Character:
+def create_character(db: Session, character: CharacterCreate, commit: bool = True) -> Character:
     db_character = Character(
         name=character.name,
         personality=character.personality,
@@ -13,8 +19,9 @@ def create_character(db: Session, character: CharacterCreate) -> Character:
         background=character.background,
         tone=character.tone,
         world=character.world,
-        prohibited=json.dumps(character.prohibited) if character.prohibited else None,
-        examples=json.dumps(character.examples) if character.examples else None,
+        prohibited=character.prohibited,
+        examples=character.examples,
+        liking_overrides=character.liking_overrides,
         openness=character.openness,
         conscientiousness=character.conscientiousness,
         extraversion=character.extraversion,
@@ -22,8 +29,12 @@ def create_character(db: Session, character: CharacterCreate) -> Character:
         neuroticism=character.neuroticism
     )
     db.add(db_character)
-    db.commit()
-    db.refresh(db_character)
+    if commit:
+        db.commit()
+        db.refresh(db_character)
+    else:
+        # 呼び出し側が同じトランザクションで他の変更と一緒にコミットする
+        db.flush()
     return db_character
 
 # 🔹 名前でキャラ取得
@@ -34,12 +45,26 @@ def get_character_by_name(db: Session, name: str) -> Optional[Character]:
 def get_all_characters(db: Session) -> List[Character]:
     return db.query(Character).all()
 
+# 🔹 キャッシュのバージョン番号取得
+def get_cache_version(db: Session, name: str) -> int:
+    row = db.get(CacheVersion, name)
+    return row.version if row else 0
+
+# 🔸 キャッシュのバージョン番号を加算（コミットは呼び出し側）
+def bump_cache_version(db: Session, name: str) -> int:
+    row = db.get(CacheVersion, name, with_for_update=True)
+    if row is None:
+        row = CacheVersion(name=name, version=0)
+        db.add(row)
+    row.version += 1
+    return row.version
+
 # 🔸 コンストラクト作成
 def create_construct(db: Session, data: ConstructCreate) -> Construct:
     construct = Construct(
         user_id=data.user_id,
         character_id=data.character_id,
-        axis=json.dumps(data.axis),
+        axis=data.axis,
         name=data.name,
         importance=data.importance,
         behavior_effect=data.behavior_effect,
@@ -58,7 +83,7 @@ def create_constructs(db: Session, constructs: List[ConstructCreate]) -> List[Co
         obj = Construct(
             user_id=data.user_id,
             character_id=data.character_id,
-            axis=json.dumps(data.axis),
+            axis=data.axis,
             name=data.name,
             importance=data.importance,
             behavior_effect=data.behavior_effect,
@@ -72,13 +97,109 @@ def create_constructs(db: Session, constructs: List[ConstructCreate]) -> List[Co
     return objs
 
 
-# 🔹 指定ユーザー・キャラのコンストラクト一覧
-def get_constructs(db: Session, user_id, character_id) -> List[Construct]:
-    return (
+# 🔸 コンストラクト一括挿入（コミットは呼び出し側）
+def bulk_insert_constructs(db: Session, constructs: List[ConstructCreate]) -> int:
+    """Insert many constructs with a single multi-row INSERT; returns the row count."""
+    if not constructs:
+        return 0
+    db.execute(
+        insert(Construct),
+        [
+            {
+                "user_id": data.user_id,
+                "character_id": data.character_id,
+                "axis": data.axis,
+                "name": data.name,
+                "importance": data.importance,
+                "behavior_effect": data.behavior_effect,
+                "value": data.value,
+            }
+            for data in constructs
+        ],
+    )
+    return len(constructs)
+
+
+# 🔹 存在するユーザーID・キャラIDの絞り込み
+def existing_user_ids(db: Session, ids) -> set:
+    return {row[0] for row in db.query(User.id).filter(User.id.in_(ids))} if ids else set()
+
+
+def existing_character_ids(db: Session, ids) -> set:
+    return {row[0] for row in db.query(Character.id).filter(Character.id.in_(ids))} if ids else set()
+
+
+# 🔹 axis に指定の極値を含むかの条件（PostgreSQL では GIN 索引が効く @> を使用）
+def axis_has_pole(db: Session, pole: str):
+    if db.get_bind().dialect.name == "postgresql":
+        return type_coerce(Construct.axis, postgresql.JSONB).contains([pole])
+    # SQLite などは json_each で配列要素を展開して比較
+    elements = func.json_each(Construct.axis).table_valued("value")
+    return select(elements.c.value).where(elements.c.value == pole).exists()
+
+
+# 🔹 指定ユーザー・キャラのコンストラクト一覧（重要度の高い順。pole 指定時はその極値を含む軸のみ）
+def get_constructs(
+    db: Session,
+    user_id,
+    character_id,
+    pole: Optional[str] = None,
+    limit: Optional[int] = None,
+) -> List[Construct]:
+    query = (
         db.query(Construct)
         .filter(Construct.user_id == user_id, Construct.character_id == character_id)
-        .all()
+        .order_by(Construct.importance.desc(), Construct.id)
     )
+    if pole is not None:
+        query = query.filter(axis_has_pole(db, pole))
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+# 🔹 複数キャラ分のコンストラクトを1クエリで取得（キャラIDごとに重要度順で分類。limit はキャラごと）
+def get_constructs_for_characters(
+    db: Session,
+    user_id,
+    character_ids,
+    limit: Optional[int] = None,
+) -> Dict[UUID, List[Construct]]:
+    grouped: Dict[UUID, List[Construct]] = {cid: [] for cid in character_ids}
+    if not character_ids:
+        return grouped
+    query = db.query(Construct).filter(
+        Construct.user_id == user_id, Construct.character_id.in_(character_ids)
+    )
+    if limit is not None:
+        # キャラごとの上位 limit 件だけを DB 側で絞り込む（ウィンドウ関数で順位付け）
+        ranked = (
+            select(
+                Construct.id,
+                func.row_number().over(
+                    partition_by=Construct.character_id,
+                    order_by=(Construct.importance.desc(), Construct.id),
+                ).label("rn"),
+            )
+            .where(Construct.user_id == user_id, Construct.character_id.in_(character_ids))
+            .subquery()
+        )
+        query = query.join(ranked, ranked.c.id == Construct.id).filter(ranked.c.rn <= limit)
+    for c in query.order_by(Construct.character_id, Construct.importance.desc(), Construct.id):
+        grouped.setdefault(c.character_id, []).append(c)
+    return grouped
+
+
+# 🔹 複数キャラ分の内部状態値を1クエリで取得
+def get_internal_state_values(db: Session, user_id, character_ids, param_name: str) -> Dict[UUID, int]:
+    if not character_ids:
+        return {}
+    rows = db.query(InternalState.character_id, InternalState.value).filter(
+        InternalState.user_id == user_id,
+        InternalState.character_id.in_(character_ids),
+        InternalState.param_name == param_name,
+    )
+    return {character_id: value or 0 for character_id, value in rows}
 
 
 # 🔹 コンストラクト削除
@@ -88,3 +209,311 @@ def delete_construct(db: Session, construct_id):
         db.delete(c)
         db.commit()
     return c
+
+
+# 🔹 履歴の並び順キー（timestamp, id）。タイムゾーン無しの値は UTC とみなす
+def history_sort_key(entry: ChatHistory) -> Tuple[datetime, str]:
+    return _as_utc(entry.timestamp), str(entry.id)
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+# 🔹 履歴ページング用カーソル（timestamp と id の組をエンコード）
+def encode_history_cursor(entry: ChatHistory) -> str:
+    raw = f"{entry.timestamp.isoformat()}|{entry.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_history_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    """Decode a cursor produced by ``encode_history_cursor``; raises ValueError if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, entry_id = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), UUID(entry_id)
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+# 🔹 履歴を新しい順に1ページ取得（キーセット方式）
+def get_chat_history_page(
+    db: Session,
+    user_id,
+    character_id,
+    limit: int,
+    before: Optional[str] = None,
+    pending: Optional[List[ChatHistory]] = None,
+) -> Tuple[List[ChatHistory], Optional[str]]:
+    """Return one page of history in chronological order and the cursor for the next (older) page.
+
+    ``pending`` holds rows that are not committed yet (write-behind); they
+    are merged into the page as if they were already stored.
+    """
+    query = db.query(ChatHistory).filter(
+        ChatHistory.user_id == user_id,
+        ChatHistory.character_id == character_id,
+    )
+    bound = None
+    if before:
+        bound = decode_history_cursor(before)
+        # 行比較だけでは (user_id, character_id, timestamp) 索引の範囲条件にならないため、
+        # 冗長な timestamp の上限も付けて索引で読み始め位置を絞る
+        query = query.filter(
+            ChatHistory.timestamp <= bound[0],
+            tuple_(ChatHistory.timestamp, ChatHistory.id) < bound,
+        )
+
+    rows = (
+        query.order_by(ChatHistory.timestamp.desc(), ChatHistory.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    if pending:
+        seen = {r.id for r in rows}
+        extra = [
+            p for p in pending
+            if p.id not in seen
+            and (bound is None or history_sort_key(p) < (_as_utc(bound[0]), str(bound[1])))
+        ]
+        rows = sorted(rows + extra, key=history_sort_key, reverse=True)[:limit + 1]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_history_cursor(rows[-1]) if has_more else None
+    rows.reverse()
+    return rows, next_cursor
+
+
+# 🔹 発言の全文検索（PostgreSQL では 1・2 文字 n-gram の GIN インデックスを利用）
+# chat_ngrams(message) は backend/migrate.py で作成する SQL 関数。分かち書きのない
+# 日本語でも、ロケールに関係なく 1〜2 文字の語から索引を引ける
+NGRAM_FUNCTION = "chat_ngrams"
+_ngram_index_available: Dict[str, bool] = {}
+
+
+def message_ngrams(term: str) -> List[str]:
+    """The n-grams ``chat_ngrams`` must contain for ``term`` to occur in a message.
+
+    Bigrams of the lower-cased term, or the character itself for a
+    one-character term (mirrors the SQL function).
+    """
+    term = term.lower()
+    if len(term) == 1:
+        return [term]
+    return sorted({term[i:i + 2] for i in range(len(term) - 1)})
+
+
+def has_ngram_index(db: Session) -> bool:
+    """True when the database has the ``chat_ngrams`` function (checked once per URL)."""
+    bind = db.get_bind()
+    if bind.dialect.name != "postgresql":
+        return False
+    key = str(bind.url)
+    if key not in _ngram_index_available:
+        _ngram_index_available[key] = db.execute(
+            text("SELECT 1 FROM pg_proc WHERE proname = :name"), {"name": NGRAM_FUNCTION}
+        ).first() is not None
+    return _ngram_index_available[key]
+
+
+def search_chat_history(
+    db: Session,
+    terms: List[str],
+    user_id=None,
+    character_id=None,
+    role: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0,
+    candidates: int = 1000,
+) -> Tuple[List[Tuple[ChatHistory, float]], bool]:
+    """Messages containing every term, best match first, with their rank.
+
+    Matching is a case-insensitive substring test, so it works on
+    unsegmented Japanese. Only the newest ``candidates`` matches are
+    ranked, which bounds the work for very common terms. The rank is the
+    share of the message covered by the terms. On PostgreSQL the n-gram
+    GIN index narrows the rows before the substring check. Returns
+    ``(rows, has_more)``.
+    """
+    conditions = [ChatHistory.message.icontains(term, autoescape=True) for term in terms]
+    if has_ngram_index(db):
+        grams = sorted({g for term in terms for g in message_ngrams(term)})
+        conditions.append(
+            type_coerce(getattr(func, NGRAM_FUNCTION)(ChatHistory.message), postgresql.ARRAY(Text))
+            .contains(grams)
+        )
+    if user_id is not None:
+        conditions.append(ChatHistory.user_id == user_id)
+    if character_id is not None:
+        conditions.append(ChatHistory.character_id == character_id)
+    if role is not None:
+        conditions.append(ChatHistory.role == role)
+
+    newest = (
+        select(ChatHistory.id)
+        .where(*conditions)
+        .order_by(ChatHistory.timestamp.desc())
+        .limit(candidates)
+    )
+    rank = cast(literal(sum(len(term) for term in terms)), Float) / func.length(ChatHistory.message)
+
+    rows = db.execute(
+        select(ChatHistory, rank.label("rank"))
+        .where(ChatHistory.id.in_(newest))
+        .order_by(rank.desc(), ChatHistory.timestamp.desc(), ChatHistory.id)
+        .offset(offset)
+        .limit(limit + 1)
+    ).all()
+    has_more = len(rows) > limit
+    return [(row[0], float(row[1] or 0)) for row in rows[:limit]], has_more
+
+
+# 🔸 内部状態の加算（INSERT ... ON CONFLICT DO UPDATE による1文での更新）
+def increment_internal_state(
+    db: Session,
+    user_id,
+    character_id,
+    param_name: str,
+    delta: int,
+    min_value: Optional[int] = None,
+    max_value: Optional[int] = None,
+) -> int:
+    """Atomically add ``delta`` to a state value and return the new value.
+
+    The row is created when missing. ``min_value``/``max_value`` clamp the
+    result inside the same statement. The caller commits.
+    """
+    def clamp(expr):
+        whens = []
+        if min_value is not None:
+            whens.append((expr < min_value, literal(min_value)))
+        if max_value is not None:
+            whens.append((expr > max_value, literal(max_value)))
+        return case(*whens, else_=expr) if whens else expr
+
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        initial = delta
+        if min_value is not None:
+            initial = max(initial, min_value)
+        if max_value is not None:
+            initial = min(initial, max_value)
+        stmt = insert(InternalState).values(
+            user_id=user_id,
+            character_id=character_id,
+            param_name=param_name,
+            value=initial,
+            updated_at=func.now(),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id", "character_id", "param_name"],
+            set_={
+                "value": clamp(func.coalesce(InternalState.value, 0) + delta),
+                "updated_at": func.now(),
+            },
+        ).returning(InternalState.value)
+        return db.execute(stmt).scalar_one()
+
+    # その他の DB では行ロック付きの読み込み→更新にフォールバック
+    state = db.query(InternalState).filter_by(
+        user_id=user_id, character_id=character_id, param_name=param_name
+    ).with_for_update().first()
+    if state is None:
+        state = InternalState(user_id=user_id, character_id=character_id, param_name=param_name, value=0)
+        db.add(state)
+    value = (state.value or 0) + delta
+    if min_value is not None:
+        value = max(value, min_value)
+    if max_value is not None:
+        value = min(value, max_value)
+    state.value = value
+    state.updated_at = func.now()
+    db.flush()
+    return value
+
+
+# 🔸 トークン使用量の時間別集計
+_ROLLUP_SUMS = ("calls", "errors", "prompt_tokens", "completion_tokens", "latency_ms")
+
+
+def add_usage_rollups(db: Session, rollups: List[dict]) -> None:
+    """Add pre-aggregated totals to ``llm_usage_hourly``, creating missing buckets.
+
+    The caller commits.
+    """
+    if not rollups:
+        return
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert(LLMUsageHourly)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["bucket", "user_id", "character_id", "call_site", "model"],
+            set_={
+                name: getattr(LLMUsageHourly, name) + getattr(stmt.excluded, name)
+                for name in _ROLLUP_SUMS
+            },
+        )
+        db.execute(stmt, rollups)
+        return
+
+    # その他の DB では行ロック付きの読み込み→更新にフォールバック
+    for r in rollups:
+        row = db.query(LLMUsageHourly).filter_by(
+            bucket=r["bucket"], user_id=r["user_id"], character_id=r["character_id"],
+            call_site=r["call_site"], model=r["model"],
+        ).with_for_update().first()
+        if row is None:
+            db.add(LLMUsageHourly(**r))
+            continue
+        for name in _ROLLUP_SUMS:
+            setattr(row, name, getattr(row, name) + r[name])
+    db.flush()
+
+
+def usage_group_columns(db: Session) -> Dict[str, object]:
+    """``group_by`` name → column expression over ``llm_usage_hourly``."""
+    if db.get_bind().dialect.name == "postgresql":
+        day = func.date_trunc("day", LLMUsageHourly.bucket)
+    else:
+        day = func.date(LLMUsageHourly.bucket)
+    return {
+        "user": LLMUsageHourly.user_id,
+        "character": LLMUsageHourly.character_id,
+        "call_site": LLMUsageHourly.call_site,
+        "model": LLMUsageHourly.model,
+        "hour": LLMUsageHourly.bucket,
+        "day": day,
+    }
+
+
+def aggregate_usage(
+    db: Session,
+    since: datetime,
+    until: datetime,
+    group_by: List[str],
+    user_id=None,
+    character_id=None,
+    call_site: Optional[str] = None,
+) -> List[dict]:
+    """Hourly rollup totals in ``[since, until)`` grouped by ``group_by`` plus model.
+
+    The model is always part of the grouping so the caller can price each
+    row before merging.
+    """
+    columns = usage_group_columns(db)
+    names = list(dict.fromkeys([*group_by, "model"]))
+    keys = [columns[name].label(name) for name in names]
+    q = (
+        select(*keys, *[func.sum(getattr(LLMUsageHourly, name)).label(name) for name in _ROLLUP_SUMS])
+        .where(LLMUsageHourly.bucket >= since, LLMUsageHourly.bucket < until)
+        .group_by(*keys)
+    )
+    if user_id is not None:
+        q = q.where(LLMUsageHourly.user_id == user_id)
+    if character_id is not None:
+        q = q.where(LLMUsageHourly.character_id == character_id)
+    if call_site is not None:
+        q = q.where(LLMUsageHourly.call_site == call_site)
+    return [dict(row._mapping) for row in db.execute(q)]
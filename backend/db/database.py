@@ -1,14 +1,78 @@
 # db/database.py
 
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, sessionmaker
+from typing import Optional
 import os
+import threading
 
-# ✅ Render上に登録したDATABASE_URLを読み込む
-DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise ValueError("❌ DATABASE_URLが設定されていません。")
+# ✅ 接続プール設定（ワーカー1プロセスあたり。環境変数で調整可能）
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1").lower() in ("1", "true", "yes")
+# 起動時にあらかじめ開いておく接続数
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", "2"))
 
-# ✅ SQLAlchemyエンジンとセッションの初期化
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# ✅ エンジンは import 時ではなく初回利用時（通常はアプリの lifespan）に作成する
+engine: Optional[Engine] = None
+_lock = threading.Lock()
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
+
+
+def create_db_engine(database_url: Optional[str] = None) -> Engine:
+    """Build an engine for ``database_url`` (default: ``DATABASE_URL``) with the pool settings."""
+    # ✅ Render上に登録したDATABASE_URLを読み込む
+    database_url = database_url or os.getenv("DATABASE_URL")
+    if not database_url:
+        raise ValueError("❌ DATABASE_URLが設定されていません。")
+
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    url = make_url(database_url)
+    # インメモリ SQLite は単一接続プールのため、プールサイズ指定は渡さない
+    if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return create_engine(url, **options)
+
+
+def init_engine(database_url: Optional[str] = None) -> Engine:
+    """Create the process-wide engine once and bind ``SessionLocal`` to it."""
+    global engine
+    with _lock:
+        if engine is None:
+            engine = create_db_engine(database_url)
+            _session_factory.configure(bind=engine)
+        return engine
+
+
+def get_engine() -> Engine:
+    """Return the process-wide engine, creating it from ``DATABASE_URL`` if needed."""
+    return engine if engine is not None else init_engine()
+
+
+def warm_pool(count: int = DB_POOL_WARMUP) -> None:
+    """Open ``count`` pooled connections up front so the first requests skip the handshake."""
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(get_engine().connect())
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+def dispose_engine() -> None:
+    """Close every pooled connection and forget the engine (e.g. on shutdown)."""
+    global engine
+    with _lock:
+        if engine is not None:
+            engine.dispose()
+            engine = None
+
+
+def SessionLocal() -> Session:
+    """Open a session on the process-wide engine (created on first use)."""
+    get_engine()
+    return _session_factory()
@@ -1,13 +1,19 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, Response
+from fastapi import APIRouter, FastAPI, Depends, Header, HTTPException, UploadFile, Response, Query, BackgroundTasks, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from openai import OpenAI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 from pathlib import Path
+from contextlib import asynccontextmanager
+from datetime import datetime
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from datetime import datetime
 from uuid import UUID
+import asyncio
 import os
 import uuid
 import json
@@ -22,8 +28,8 @@ env_path = Path(".") / ".env"
 load_dotenv(dotenv_path=env_path)
 
 # ✅ 自作モジュール
-from backend.models.models import Base, Character, ChatHistory, User, InternalState
-from backend.db.database import engine
+from backend.models.models import Base, Character, ChatHistory, Construct, User, InternalState
+from backend.db.database import SessionLocal, dispose_engine, get_engine, init_engine, warm_pool
 from backend.schemas.schemas import (
     CharacterCreate,
     CharacterResponse,
@@ -31,38 +37,136 @@ from backend.schemas.schemas import (
     ChatMessage,
     ChatHistoryResponse,
     ChatRequest,
+    GroupChatRequest,
+    SessionMessage,
     UserCreate,
     EvaluateLikingRequest,
+    EvaluateLikingBatchRequest,
+    TurnRequest,
     ConstructCreate,
     ConstructResponse,
 )
 from backend.crud.crud import (
-    get_all_characters,
     create_character,
     get_character_by_name,
-    create_construct,
     create_constructs,
     get_constructs,
+    get_constructs_for_characters,
+    get_internal_state_values,
     delete_construct,
+    get_chat_history_page,
+    history_sort_key,
+    increment_internal_state,
+    bulk_insert_constructs,
+    existing_user_ids,
+    existing_character_ids,
+    aggregate_usage,
+    search_chat_history,
 )
 from backend.dependencies.dependencies import get_db
+from backend.services.character_cache import character_cache, etag_matches, to_character_response
+from backend.services.construct_selection import CONSTRUCT_CANDIDATES, select_constructs, selection_debug
+from backend.services.context import ConversationContext, load_context, refresh_summary
+from backend.services.export import jsonl_response
+from backend.services.history_search import (
+    SEARCH_CANDIDATES,
+    SEARCH_MAX_QUERY_CHARS,
+    make_snippet,
+    parse_query,
+)
+from backend.services.history_writer import history_writer, make_history_row
+from backend.services.idempotency import idempotency, request_fingerprint
+from backend.services.intent_cache import intent_cache
+from backend.services.liking_scorer import LocalDecision, classify_liking
+from backend.services.llm_gateway import LLMGateway, create_gateway
+from backend.services.metrics import (
+    MetricsMiddleware,
+    instrument_engine,
+    render_metrics,
+    stage,
+)
+from backend.services.session import ConversationSession, sessions
+from backend.services.usage_ledger import USAGE_GROUPS, summarize_usage, usage_ledger, usage_window
+from backend.services.prompts import LIKING_MAX, LIKING_MIN, build_full_prompt, map_liking_to_level, prompt_cache
+
+# ✅ OpenAI クライアントと LLM ゲートウェイは lifespan で作成する（import 時には作らない）
+client = None
+llm: Optional[LLMGateway] = None
+
+# バッチ評価1回あたりの最大件数
+EVAL_BATCH_MAX_ITEMS = int(os.getenv("EVAL_BATCH_MAX_ITEMS", "32"))
+
+# グループ会話1回あたりの最大キャラ数
+GROUP_CHAT_MAX_CHARACTERS = int(os.getenv("GROUP_CHAT_MAX_CHARACTERS", "8"))
 
-app = FastAPI()
+# 好感度を map_liking_to_level の範囲（LIKING_MIN〜LIKING_MAX）に収めるか
+LIKING_CLAMP = os.getenv("LIKING_CLAMP", "").lower() in ("1", "true", "yes")
 
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("❌ OPENAI_API_KEYが設定されていません。")
 
-client = OpenAI(api_key=api_key)
+def _create_openai_client() -> AsyncOpenAI:
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("❌ OPENAI_API_KEYが設定されていません。")
+    # ✅ 非同期クライアント（イベントループ上で待機し、スレッドプールを占有しない）
+    # 再試行は LLM ゲートウェイ側で行うため、クライアント自身の再試行は無効化
+    return AsyncOpenAI(api_key=api_key, max_retries=0)
 
 
-def extract_intent(user_message: str) -> str:
-    """Call GPT to extract a concise conversation intent."""
+def _warm_up() -> None:
+    """Open pooled connections, load the character catalog and compile prompts."""
+    warm_pool()
+    with SessionLocal() as db:
+        for character in character_cache.characters(db):
+            prompt_cache.get(character)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build per-worker resources before serving and dispose them on shutdown."""
+    global client, llm
+    engine = init_engine(app.state.database_url)
+    # ✅ SQL の実行回数・所要時間を計測
+    instrument_engine(engine)
+
+    client = app.state.openai_client or _create_openai_client()
+    # ✅ すべての GPT 呼び出しはゲートウェイ経由（同時実行数制限・タイムアウト・再試行・公平制御）
+    llm = create_gateway(client)
+
+    await run_in_threadpool(_warm_up)
+    history_writer.start()
+    usage_ledger.start()
+    try:
+        yield
+    finally:
+        # 終了時に未書き込みの履歴・使用量をすべて書き出す
+        # 実行中の要約更新を待ってから書き出し・クライアント終了に進む
+        if _summary_tasks:
+            await asyncio.gather(*list(_summary_tasks), return_exceptions=True)
+        await run_in_threadpool(history_writer.stop)
+        await run_in_threadpool(usage_ledger.stop)
+        if app.state.openai_client is None:
+            await client.close()
+        character_cache.invalidate()
+        prompt_cache.invalidate()
+        dispose_engine()
+
+
+async def extract_intent(user_message: str, user_id: Optional[UUID] = None) -> str:
+    """Call GPT to extract a concise conversation intent.
+
+    Results are memoized by normalized message in ``intent_cache``.
+    """
+    cache_key, cached = await intent_cache.lookup(user_message)
+    if cached is not None:
+        return cached
+
     system_prompt = (
         "あなたはユーザーの発言から会話の意図を1文で抽出するアシスタントです。"
     )
     try:
-        response = client.chat.completions.create(
+        response = await llm.chat_completion(
+            "intent",
+            user_id=user_id,
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -71,21 +175,38 @@ def extract_intent(user_message: str) -> str:
             temperature=0.5,
             max_tokens=50,
         )
-        return response.choices[0].message.content.strip()
+        intent = response.choices[0].message.content.strip()
     except Exception as e:
         logger.error("❌ GPT意図抽出エラー: %s", str(e))
         return ""
 
+    await intent_cache.store(cache_key, intent)
+    return intent
 
-def evaluate_liking_character_view(
+
+async def evaluate_liking_character_view(
     player_message: str,
-    character: Character,
+    character: CharacterResponse,
     constructs: List[ConstructResponse],
     liking_raw: int,
     return_raw: bool = False,
-) -> tuple[int, str, str, str | None, dict | None]:
-    """Evaluate liking from the character view and optionally return debug info."""
-    intent = extract_intent(player_message)
+    intent: Optional[str] = None,
+    user_id: Optional[UUID] = None,
+    local: Optional[LocalDecision] = None,
+) -> tuple[int, str, str, str | None, dict | None, dict]:
+    """Evaluate liking from the character view and optionally return debug info.
+
+    Trivial messages are scored by the local pre-classifier without any GPT
+    call; the last element is its decision path. ``intent`` and ``local``
+    can be supplied by callers that already computed them.
+    """
+    if local is None:
+        local = classify_liking(player_message, character.liking_overrides)
+    if local.accepted:
+        return local.score, local.reason, intent or local.intent, None, None, local.as_debug()
+
+    if intent is None:
+        intent = await extract_intent(player_message, user_id)
     liking_level = map_liking_to_level(liking_raw)
     eval_instruction = (
         "\nあなたは上記キャラクターとして、以下のプレイヤー発言がもたらす\n"
@@ -95,7 +216,7 @@ def evaluate_liking_character_view(
     system_prompt = build_full_prompt(
         character,
         liking_level,
-        constructs,
+        select_constructs(constructs, intent, player_message),
         intent,
     ) + eval_instruction
     messages = [
@@ -104,7 +225,10 @@ def evaluate_liking_character_view(
     ]
 
     try:
-        response = client.chat.completions.create(
+        response = await llm.chat_completion(
+            "eval",
+            user_id=user_id,
+            character_id=character.id,
             model="gpt-4o",
             messages=messages,
             temperature=0.3,
@@ -126,148 +250,184 @@ def evaluate_liking_character_view(
         reason = ""
         raw_json = None
 
-    return score, reason, intent, system_prompt if return_raw else None, raw_json
+    return score, reason, intent, system_prompt if return_raw else None, raw_json, local.as_debug()
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-def map_liking_to_level(liking: int) -> int:
-    """Convert raw liking value to a discrete level."""
-    if liking <= -5:
-        return 0
-    elif liking <= -2:
-        return 1
-    elif liking <= 1:
-        return 2
-    elif liking <= 4:
-        return 3
-    else:
-        return 4
-
-def build_full_prompt(character, liking_level: int, constructs=None, intent: Optional[str] = None) -> str:
-    def get_prompt_by_level(level: int) -> str:
-        prompt_map = {
-            0: "相手を嫌っているように、冷たく、感情を抑えて応答してください。",
-            1: "相手に警戒しつつ、距離を取りつつ応答してください。",
-            2: "",  # 中立
-            3: "相手に少し好意を持ち、優しく応答してください。",
-            4: "非常に親しい相手として、親しみを込めて応答してください。"
-        }
-        return prompt_map.get(level, "")
+def _attach_eval_prompt(target: dict, key: str, prompt_debug: Optional[str], player_message: str, scorer: dict) -> None:
+    """Add the liking prompt for ``include_prompt``.
+
+    Messages decided by the local scorer never reach GPT, so there is no
+    prompt; the scorer's decision path is returned instead.
+    """
+    if prompt_debug is None:
+        target["scorer"] = scorer
+        return
+    target[key] = [
+        {"role": "system", "content": prompt_debug},
+        {"role": "user", "content": player_message},
+    ]
+
+
+async def generate_reply(
+    system_prompt: dict,
+    messages: List[dict],
+    user_id: Optional[UUID] = None,
+    character_id: Optional[UUID] = None,
+) -> tuple[str, dict]:
+    """Generate the character reply for an already assembled prompt."""
+    response = await llm.chat_completion(
+        "reply",
+        user_id=user_id,
+        character_id=character_id,
+        model="gpt-4o",
+        messages=[system_prompt] + messages,
+        temperature=0.8,
+        max_tokens=200
+    )
+    return response.choices[0].message.content, response.model_dump()
+
+async def _run_idempotent(endpoint: str, payload, idempotency_key: Optional[str], response: Response, handler):
+    """Run ``handler`` through ``idempotency`` and mark replayed responses."""
+    body, replayed = await idempotency.run(
+        endpoint, payload.user_id, idempotency_key, request_fingerprint(payload), handler
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return body
 
-    prohibited_text = "\n".join(f"- {item}" for item in json.loads(character.prohibited)) if character.prohibited else "なし"
-    examples_text = "\n".join(
-        f"ユーザー: {ex['user']}\nキャラ: {ex['assistant']}"
-        for ex in json.loads(character.examples)
-    ) if character.examples else "なし"
-    liking_text = get_prompt_by_level(liking_level)
-    intent_text = f"\n【ユーザーの意図】\n{intent}" if intent else ""
-    def format_construct(c):
-        axis = json.loads(c.axis) if isinstance(c.axis, str) else c.axis
-        pair = f"{axis[0]} ↔ {axis[1]}" if len(axis) == 2 else ",".join(axis)
-        return f"- {c.name} ({pair}) = {c.value} / importance {c.importance}\n  {c.behavior_effect}"
+router = APIRouter()
 
-    constructs_text = "\n".join(format_construct(c) for c in constructs) if constructs else "なし"
+@router.get("/reset-db")
+def reset_db():
+    engine = get_engine()
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    character_cache.invalidate()
+    prompt_cache.invalidate()
+    return {"status": "✅ データベースをUUID対応で再作成しました"}
 
-    return f"""あなたは「{character.name}」というキャラクターとして対話を行います。
+def _release_connection(db: Session) -> None:
+    """End the read transaction so the pooled connection is not held across an LLM call.
 
-このキャラクターの性格は Big Five モデルに基づき、以下の通り数値で表されています。
-スコアは 0.0（非常に低い）〜 1.0（非常に高い）の範囲です。
+    ``close()`` detaches the loaded objects (their attributes stay readable)
+    and the session reconnects on its next use, e.g. to save the turn.
+    """
+    db.close()
 
-- Openness: {character.openness}
-- Conscientiousness: {character.conscientiousness}
-- Extraversion: {character.extraversion}
-- Agreeableness: {character.agreeableness}
-- Neuroticism: {character.neuroticism}
 
-これらの性格特性に基づき、発言内容・話し方・反応を自然に調整してください。
+def _load_chat_context(db: Session, user_id: UUID, character_id: UUID):
+    """Load context window, character, liking and constructs for a chat turn."""
+    try:
+        character = character_cache.get(db, character_id)
+        if not character:
+            return None, None, None, []
 
-【背景】
-{character.background}
+        history = load_context(db, user_id, character_id)
 
-【世界観】
-{character.world}
+        state = db.query(InternalState).filter_by(
+            user_id=user_id,
+            character_id=character_id,
+            param_name="liking"
+        ).first()
 
-【口調】
-{character.tone}
+        constructs = get_constructs(db, user_id, character_id, limit=CONSTRUCT_CANDIDATES)
+        return history, character, state, constructs
+    finally:
+        _release_connection(db)
 
-【禁止事項】
-{prohibited_text}
 
-【会話例】
-{examples_text}
+def _schedule_summary_refresh(background_tasks: BackgroundTasks, history: ConversationContext, user_id: UUID, character_id: UUID) -> None:
+    """Queue a rolling-summary refresh when enough turns left the context window."""
+    if history.refresh_until is not None:
+        background_tasks.add_task(refresh_summary, llm, user_id, character_id, history.refresh_until)
 
-【価値軸】
-{constructs_text}
 
-{liking_text}{intent_text}
-"""
+# WebSocket 経由の要約更新タスク（参照を保持しないと GC で途中破棄されうる）
+_summary_tasks: set = set()
 
-@app.get("/reset-db")
-def reset_db():
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
-    return {"status": "✅ データベースをUUID対応で再作成しました"}
 
-@app.post("/chat")
-def chat(request: ChatRequest, db: Session = Depends(get_db)):
-    history = db.query(ChatHistory).filter(
-        ChatHistory.user_id == request.user_id,
-        ChatHistory.character_id == request.character_id
-    ).order_by(ChatHistory.timestamp.asc()).limit(10).all()
+def _summary_task_done(task: asyncio.Task) -> None:
+    _summary_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("⚠️ 要約更新エラー: %s", str(task.exception()))
+
+
+def _spawn_summary_refresh(user_id: UUID, character_id: UUID, until: datetime) -> None:
+    """Run a rolling-summary refresh outside a request, keeping a reference until it ends."""
+    task = asyncio.ensure_future(refresh_summary(llm, user_id, character_id, until))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_task_done)
 
-    messages = [{"role": h.role, "content": h.message} for h in history]
-    messages.append({"role": "user", "content": request.user_message})
 
-    character = db.query(Character).filter(Character.id == request.character_id).first()
+def _save_chat_turn(
+    db: Session,
+    user_id: UUID,
+    character_id: UUID,
+    user_message: str,
+    reply: str,
+    commit: bool = True,
+) -> None:
+    """Persist the user message and the assistant reply of one turn.
+
+    With write-behind enabled the rows are handed to ``history_writer``
+    instead of being committed on the request path.
+    """
+    rows = [
+        make_history_row(user_id, character_id, "user", user_message),
+        make_history_row(user_id, character_id, "assistant", reply),
+    ]
+    if history_writer.enqueue(rows):
+        return
+    db.add_all(ChatHistory(**row) for row in rows)
+    if commit:
+        with stage("db_commit"):
+            db.commit()
+
+
+@router.post("/chat")
+async def chat(
+    request: ChatRequest,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """Reply to one player message; supports ``Idempotency-Key``."""
+    return await _run_idempotent(
+        "chat", request, idempotency_key, response,
+        lambda: _chat_turn(request, background_tasks, db),
+    )
+
+
+async def _chat_turn(request: ChatRequest, background_tasks: BackgroundTasks, db: Session) -> tuple[dict, bool]:
+    # DB アクセスは同期ドライバのためスレッドプールで実行し、イベントループを塞がない
+    history, character, state, constructs = await run_in_threadpool(
+        _load_chat_context, db, request.user_id, request.character_id
+    )
     if not character:
         raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
 
-    state = db.query(InternalState).filter_by(
-        user_id=request.user_id,
-        character_id=request.character_id,
-        param_name="liking"
-    ).first()
-    liking = state.value if state else 0
-    liking_level = map_liking_to_level(liking)
+    messages = history.as_messages()
+    messages.append({"role": "user", "content": request.user_message})
 
-    constructs = get_constructs(db, request.user_id, request.character_id)
+    liking_level = map_liking_to_level(state.value if state else 0)
 
-    intent = request.intent or extract_intent(request.user_message)
-    full_system_prompt = build_full_prompt(character, liking_level, constructs, intent)
+    intent = request.intent or await extract_intent(request.user_message, request.user_id)
+    selected = select_constructs(constructs, intent, request.user_message)
+    full_system_prompt = build_full_prompt(character, liking_level, selected, intent)
     system_prompt = {"role": "system", "content": full_system_prompt}
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[system_prompt] + messages,
-            temperature=0.8,
-            max_tokens=200
-        )
-        reply = response.choices[0].message.content
-        gpt_raw = response.model_dump()
+        reply, gpt_raw = await generate_reply(system_prompt, messages, request.user_id, request.character_id)
     except Exception as e:
         logger.error("❌ GPT API エラー: %s", str(e))
-        return {"reply": f"エラーが発生しました: {str(e)}"}
+        # 何も保存していないので、同じ Idempotency-Key での再送は再実行させる
+        return {"reply": f"エラーが発生しました: {str(e)}"}, False
 
-    db.add(ChatHistory(
-        user_id=request.user_id,
-        character_id=request.character_id,
-        role="user",
-        message=request.user_message
-    ))
-    db.add(ChatHistory(
-        user_id=request.user_id,
-        character_id=request.character_id,
-        role="assistant",
-        message=reply
-    ))
-    db.commit()
+    await run_in_threadpool(
+        _save_chat_turn, db, request.user_id, request.character_id, request.user_message, reply
+    )
+    _schedule_summary_refresh(background_tasks, history, request.user_id, request.character_id)
 
     response_data = {"reply": reply}
     if request.debug:
@@ -275,26 +435,316 @@ def chat(request: ChatRequest, db: Session = Depends(get_db)):
         response_data["gpt_debug"] = gpt_raw
     if request.include_prompt:
         response_data["prompt"] = [system_prompt] + messages
+        response_data["constructs"] = selection_debug(constructs, intent, request.user_message)
+    return response_data, True
+
+def _load_group_chat_context(db: Session, user_id: UUID, character_ids: List[UUID]):
+    """Load characters, context windows, constructs and liking for a group turn.
+
+    Constructs and liking values are read with one query each; the context
+    window is still loaded per character since every pair has its own history.
+    """
+    try:
+        characters = {cid: character_cache.get(db, cid) for cid in character_ids}
+        found = [cid for cid, character in characters.items() if character]
+        histories = {cid: load_context(db, user_id, cid) for cid in found}
+        constructs = get_constructs_for_characters(db, user_id, found, limit=CONSTRUCT_CANDIDATES)
+        likings = get_internal_state_values(db, user_id, found, "liking")
+        return characters, histories, constructs, likings
+    finally:
+        _release_connection(db)
+
+
+def _save_group_chat_turn(db: Session, user_id: UUID, user_message: str, replies: List[tuple[UUID, str]]) -> None:
+    """Persist the user message and reply for every character in one bulk insert."""
+    rows = []
+    for character_id, reply in replies:
+        rows.append(make_history_row(user_id, character_id, "user", user_message))
+        rows.append(make_history_row(user_id, character_id, "assistant", reply))
+    if not rows or history_writer.enqueue(rows):
+        return
+    db.execute(insert(ChatHistory), rows)
+    with stage("db_commit"):
+        db.commit()
+
+
+@router.post("/chat/group")
+async def chat_group(request: GroupChatRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Deliver one player message to several characters at once.
+
+    Each character replies with its own persona prompt, liking level and
+    constructs. The intent is extracted once and the completions run
+    concurrently, so wall-clock time tracks the slowest reply rather than
+    the party size. A failed reply is reported for that character only and
+    its rows are not saved.
+    """
+    character_ids = list(dict.fromkeys(request.character_ids))
+    if not character_ids:
+        raise HTTPException(status_code=400, detail="character_ids が空です")
+    if len(character_ids) > GROUP_CHAT_MAX_CHARACTERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"一度に会話できるのは {GROUP_CHAT_MAX_CHARACTERS} キャラまでです",
+        )
+
+    characters, histories, constructs, likings = await run_in_threadpool(
+        _load_group_chat_context, db, request.user_id, character_ids
+    )
+    missing = [str(cid) for cid in character_ids if not characters[cid]]
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"キャラクターが見つかりません: {', '.join(missing)}",
+        )
+
+    intent = request.intent or await extract_intent(request.user_message, request.user_id)
+
+    prompts = {}
+    for cid in character_ids:
+        messages = histories[cid].as_messages()
+        messages.append({"role": "user", "content": request.user_message})
+        system_prompt = {
+            "role": "system",
+            "content": build_full_prompt(
+                characters[cid],
+                map_liking_to_level(likings.get(cid, 0)),
+                select_constructs(constructs[cid], intent, request.user_message),
+                intent,
+            ),
+        }
+        prompts[cid] = (system_prompt, messages)
+
+    results = await asyncio.gather(
+        *(generate_reply(*prompts[cid], request.user_id, cid) for cid in character_ids),
+        return_exceptions=True,
+    )
+
+    saved = []
+    replies = []
+    for cid, result in zip(character_ids, results):
+        entry = {"character_id": cid, "name": characters[cid].name}
+        if isinstance(result, BaseException):
+            logger.error("❌ GPT API エラー (%s): %s", characters[cid].name, str(result))
+            entry["reply"] = f"エラーが発生しました: {str(result)}"
+            entry["error"] = True
+        else:
+            reply, gpt_raw = result
+            saved.append((cid, reply))
+            entry["reply"] = reply
+            if request.debug:
+                entry["gpt_debug"] = gpt_raw
+        if request.include_prompt:
+            system_prompt, messages = prompts[cid]
+            entry["prompt"] = [system_prompt] + messages
+            entry["constructs"] = selection_debug(constructs[cid], intent, request.user_message)
+        replies.append(entry)
+
+    await run_in_threadpool(_save_group_chat_turn, db, request.user_id, request.user_message, saved)
+    for cid, _ in saved:
+        _schedule_summary_refresh(background_tasks, histories[cid], request.user_id, cid)
+
+    response_data = {"replies": replies}
+    if request.debug:
+        response_data["intent"] = intent
     return response_data
 
-@app.post("/history/")
-def save_chat_message(chat: ChatMessage, db: Session = Depends(get_db)):
-    new_message = ChatHistory(
-        user_id=chat.user_id,
-        character_id=chat.character_id,
-        role=chat.role,
-        message=chat.message
+async def stream_reply(
+    system_prompt: dict,
+    messages: List[dict],
+    user_id: Optional[UUID],
+    character_id: Optional[UUID],
+    meta: dict,
+):
+    """Yield reply tokens as they arrive; ``meta`` collects model, finish_reason and usage."""
+    meta.update(model=None, finish_reason=None, usage=None)
+    async with llm.stream_chat_completion(
+        "reply_stream",
+        user_id=user_id,
+        character_id=character_id,
+        model="gpt-4o",
+        messages=[system_prompt] + messages,
+        temperature=0.8,
+        max_tokens=200,
+        stream_options={"include_usage": True},
+    ) as stream:
+        async for chunk in stream:
+            meta["model"] = getattr(chunk, "model", meta["model"])
+            if getattr(chunk, "usage", None):
+                meta["usage"] = chunk.usage.model_dump()
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            meta["finish_reason"] = choice.finish_reason or meta["finish_reason"]
+            token = choice.delta.content
+            if token:
+                yield token
+
+
+def _sse(event: str, data: dict) -> str:
+    """Format one Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """Streaming variant of ``/chat`` using Server-Sent Events.
+
+    Emits ``token`` events as the completion arrives and a final ``done``
+    event carrying the full reply (plus intent/debug data when requested).
+    The turn is persisted to ChatHistory once the stream has completed.
+    """
+    history, character, state, constructs = await run_in_threadpool(
+        _load_chat_context, db, request.user_id, request.character_id
     )
-    db.add(new_message)
-    db.commit()
+    if not character:
+        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+
+    messages = history.as_messages()
+    messages.append({"role": "user", "content": request.user_message})
+
+    liking_level = map_liking_to_level(state.value if state else 0)
+    intent = request.intent or await extract_intent(request.user_message, request.user_id)
+    system_prompt = {
+        "role": "system",
+        "content": build_full_prompt(
+            character, liking_level, select_constructs(constructs, intent, request.user_message), intent
+        ),
+    }
+
+    async def event_stream():
+        parts = []
+        meta = {}
+        try:
+            async for token in stream_reply(system_prompt, messages, request.user_id, request.character_id, meta):
+                parts.append(token)
+                yield _sse("token", {"token": token})
+        except Exception as e:
+            logger.error("❌ GPT API エラー: %s", str(e))
+            yield _sse("error", {"detail": f"エラーが発生しました: {str(e)}"})
+            return
+
+        reply = "".join(parts)
+
+        # レスポンス完了後に保存（依存性注入のセッションは既に閉じている可能性があるため新規に開く）
+        def persist():
+            with SessionLocal() as session:
+                _save_chat_turn(session, request.user_id, request.character_id, request.user_message, reply)
+
+        await run_in_threadpool(persist)
+
+        done = {"reply": reply}
+        if request.debug:
+            done["intent"] = intent
+            done["gpt_debug"] = meta
+        if request.include_prompt:
+            done["prompt"] = [system_prompt] + messages
+            done["constructs"] = selection_debug(constructs, intent, request.user_message)
+        yield _sse("done", done)
+
+    _schedule_summary_refresh(background_tasks, history, request.user_id, request.character_id)
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.post("/history/")
+def save_chat_message(chat: ChatMessage, db: Session = Depends(get_db)):
+    if history_writer.running:
+        # 遅延書き込みでは保存時の外部キー違反を返せないため、受け付け前に確認する
+        if db.get(User, chat.user_id) is None:
+            raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+        if not character_cache.get(db, chat.character_id):
+            raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+    row = make_history_row(chat.user_id, chat.character_id, chat.role, chat.message)
+    if not history_writer.enqueue([row]):
+        db.add(ChatHistory(**row))
+        db.commit()
     return {"status": "success"}
 
-@app.get("/history/{user_id}/{character_id}")
-def get_chat_history(user_id: UUID, character_id: UUID, db: Session = Depends(get_db)):
-    history = db.query(ChatHistory).filter(
-        ChatHistory.user_id == user_id,
-        ChatHistory.character_id == character_id
-    ).order_by(ChatHistory.timestamp).all()
+@router.get("/history/search")
+def search_history(
+    q: str = Query(..., min_length=1, max_length=SEARCH_MAX_QUERY_CHARS),
+    user_id: Optional[UUID] = None,
+    character_id: Optional[UUID] = None,
+    role: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+):
+    """Keyword search over chat messages of a user and/or character.
+
+    Whitespace-separated terms must all appear in the message. Results are
+    ranked, paginated with ``offset`` (see ``next_offset``) and carry a
+    snippet with the ``[start, end)`` offsets of each match.
+    """
+    if user_id is None and character_id is None:
+        raise HTTPException(status_code=400, detail="user_id または character_id を指定してください")
+    terms = parse_query(q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="検索語を指定してください")
+
+    rows, has_more = search_chat_history(
+        db, terms, user_id, character_id, role, limit, offset, candidates=SEARCH_CANDIDATES
+    )
+    results = []
+    for h, rank in rows:
+        snippet, highlights = make_snippet(h.message, terms)
+        results.append({
+            "id": h.id,
+            "user_id": h.user_id,
+            "character_id": h.character_id,
+            "speaker": h.role,
+            "message": h.message,
+            "timestamp": h.timestamp.isoformat(),
+            "rank": round(rank, 4),
+            "snippet": snippet,
+            "highlights": highlights,
+        })
+    return {
+        "query": q,
+        "terms": terms,
+        "results": results,
+        "next_offset": offset + limit if has_more else None,
+    }
+
+@router.get("/history/{user_id}/{character_id}")
+def get_chat_history(
+    user_id: UUID,
+    character_id: UUID,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    before: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """Return chat history in chronological order.
+
+    Without ``limit`` the whole history is returned. With ``limit`` only the
+    newest page is returned; pass the ``X-Next-Before`` response header back
+    as ``before`` to fetch the next older page.
+    """
+    # 遅延書き込みでまだ DB に入っていない発言も含める
+    pending = history_writer.pending_for(user_id, character_id)
+    if limit is None and before is None:
+        history = db.query(ChatHistory).filter(
+            ChatHistory.user_id == user_id,
+            ChatHistory.character_id == character_id
+        ).order_by(ChatHistory.timestamp).all()
+        if pending:
+            seen = {h.id for h in history}
+            history = sorted(
+                history + [p for p in pending if p.id not in seen],
+                key=history_sort_key,
+            )
+    else:
+        try:
+            history, next_cursor = get_chat_history_page(
+                db, user_id, character_id, limit or 50, before, pending=pending
+            )
+        except ValueError:
+            raise HTTPException(status_code=400, detail="不正なカーソルです")
+        if next_cursor:
+            response.headers["X-Next-Before"] = next_cursor
 
     return [
         {
@@ -304,61 +754,62 @@ def get_chat_history(user_id: UUID, character_id: UUID, db: Session = Depends(ge
         } for h in history
     ]
 
-@app.post("/characters/", response_model=CharacterResponse)
+@router.post("/characters/", response_model=CharacterResponse)
 def create_character_route(character: CharacterCreate, db: Session = Depends(get_db)):
     logger.info("▶️ キャラクター作成リクエスト受信: %s", character.dict())
     db_character = get_character_by_name(db, character.name)
     if db_character:
         raise HTTPException(status_code=400, detail="❌ 名前が既に使われています")
     try:
-        result = create_character(db, character)
-        result.prohibited = json.loads(result.prohibited) if result.prohibited else None
-        result.examples = json.loads(result.examples) if result.examples else None
+        result = create_character(db, character, commit=False)
+        character_cache.bump(db)
+        db.commit()
+        db.refresh(result)
+        character_cache.invalidate()
         logger.info("✅ キャラクター作成成功: %s", result.id)
-        return result
+        return to_character_response(result)
     except Exception as e:
         logger.exception("❌ キャラクター作成中にエラー: %s", str(e))
         raise HTTPException(status_code=500, detail="サーバー内部エラーが発生しました")
 
-@app.put("/characters/{name}", response_model=CharacterResponse)
+@router.put("/characters/{name}", response_model=CharacterResponse)
 def update_character_route(name: str, update_data: CharacterUpdate, db: Session = Depends(get_db)):
     character = db.query(Character).filter(Character.name == name).first()
     if not character:
         raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
 
     update_fields = update_data.dict(exclude_unset=True)
-    if "prohibited" in update_fields and isinstance(update_fields["prohibited"], list):
-        update_fields["prohibited"] = json.dumps(update_fields["prohibited"])
-    if "examples" in update_fields and isinstance(update_fields["examples"], list):
-        update_fields["examples"] = json.dumps(update_fields["examples"])
-
     for key, value in update_fields.items():
         setattr(character, key, value)
 
+    character_cache.bump(db)
     db.commit()
+    character_cache.invalidate()
+    prompt_cache.invalidate(character.id)
     db.refresh(character)
-    character.prohibited = json.loads(character.prohibited) if character.prohibited else None
-    character.examples = json.loads(character.examples) if character.examples else None
-    return character
-
-@app.get("/characters/", response_model=List[CharacterResponse])
-def get_characters_route(db: Session = Depends(get_db)):
-    characters = get_all_characters(db)
-    for char in characters:
-        char.prohibited = json.loads(char.prohibited) if char.prohibited else None
-        char.examples = json.loads(char.examples) if char.examples else None
-    return characters
-
-@app.delete("/characters/{id}")
+    return to_character_response(character)
+
+@router.get("/characters/", response_model=List[CharacterResponse])
+def get_characters_route(request: Request, db: Session = Depends(get_db)):
+    """Character catalog served from the cache; supports If-None-Match."""
+    body, etag = character_cache.catalog(db)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+@router.delete("/characters/{id}")
 def delete_character_route(id: UUID, db: Session = Depends(get_db)):
     character = db.query(Character).filter(Character.id == id).first()
     if not character:
         raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
     db.delete(character)
+    character_cache.bump(db)
     db.commit()
+    character_cache.invalidate()
+    prompt_cache.invalidate(id)
     return {"message": f"キャラクターID: {id} を削除しました"}
 
-@app.post("/users/")
+@router.post("/users/")
 def create_user(user: UserCreate, db: Session = Depends(get_db)):
     existing = db.query(User).filter(User.username == user.username).first()
     if existing:
@@ -369,79 +820,487 @@ def create_user(user: UserCreate, db: Session = Depends(get_db)):
     db.refresh(new_user)
     return {"id": new_user.id, "username": new_user.username}
 
-@app.post("/evaluate-liking")
-def evaluate_liking(data: EvaluateLikingRequest, db: Session = Depends(get_db)):
-    character = db.query(Character).filter(Character.id == data.character_id).first()
-    if not character:
-        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+def _load_liking_context(db: Session, user_id: UUID, character_id: UUID):
+    """Load character, constructs and the liking state row for an evaluation."""
+    try:
+        character = character_cache.get(db, character_id)
+        if not character:
+            return None, [], None
 
-    constructs = get_constructs(db, data.user_id, data.character_id)
+        constructs = get_constructs(db, user_id, character_id, limit=CONSTRUCT_CANDIDATES)
 
-    state = db.query(InternalState).filter_by(
-        user_id=data.user_id,
-        character_id=data.character_id,
-        param_name="liking",
-    ).first()
+        state = db.query(InternalState).filter_by(
+            user_id=user_id,
+            character_id=character_id,
+            param_name="liking",
+        ).first()
+        return character, constructs, state
+    finally:
+        _release_connection(db)
+
+
+def _apply_liking_score(
+    db: Session,
+    user_id: UUID,
+    character_id: UUID,
+    score: int,
+    commit: bool = True,
+) -> int:
+    """Add ``score`` to the liking state in one upsert and return the new value."""
+    new_value = increment_internal_state(
+        db,
+        user_id,
+        character_id,
+        "liking",
+        score,
+        min_value=LIKING_MIN if LIKING_CLAMP else None,
+        max_value=LIKING_MAX if LIKING_CLAMP else None,
+    )
+    if commit:
+        with stage("db_commit"):
+            db.commit()
+    return new_value
+
+
+@router.post("/evaluate-liking")
+async def evaluate_liking(
+    data: EvaluateLikingRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """Score one player message and apply it to liking; supports ``Idempotency-Key``."""
+    return await _run_idempotent(
+        "evaluate-liking", data, idempotency_key, response,
+        lambda: _evaluate_liking(data, db),
+    )
+
+
+async def _evaluate_liking(data: EvaluateLikingRequest, db: Session) -> tuple[dict, bool]:
+    character, constructs, state = await run_in_threadpool(
+        _load_liking_context, db, data.user_id, data.character_id
+    )
+    if not character:
+        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
     liking_raw = state.value if state else 0
 
-    score, reason, intent, prompt_debug, gpt_raw = evaluate_liking_character_view(
+    score, reason, intent, prompt_debug, gpt_raw, scorer = await evaluate_liking_character_view(
         data.player_message,
         character,
         constructs,
         liking_raw,
         return_raw=data.debug or data.include_prompt,
+        user_id=data.user_id,
     )
 
-    if state:
-        state.value += score
-        state.updated_at = datetime.utcnow()
-    else:
-        state = InternalState(
-            user_id=data.user_id,
-            character_id=data.character_id,
-            param_name="liking",
-            value=score,
-            updated_at=datetime.utcnow(),
-        )
-        db.add(state)
-
-    db.commit()
+    new_liking = await run_in_threadpool(
+        _apply_liking_score, db, data.user_id, data.character_id, score
+    )
 
     response_data = {
-        "new_liking": state.value,
+        "new_liking": new_liking,
         "score": score,
         "reason": reason,
         "intent": intent,
     }
     if data.debug:
         response_data["gpt_debug"] = gpt_raw
+        response_data["scorer"] = scorer
     if data.include_prompt:
-        response_data["prompt"] = [
-            {"role": "system", "content": prompt_debug},
-            {"role": "user", "content": data.player_message},
-        ]
-    return response_data
+        _attach_eval_prompt(response_data, "prompt", prompt_debug, data.player_message, scorer)
+        response_data["constructs"] = selection_debug(constructs, intent, data.player_message)
+    return response_data, True
+
+
+def _load_liking_batch_context(db: Session, user_id: UUID, character_ids: List[UUID]):
+    """Load characters, constructs and liking values for several characters.
+
+    Characters come from the catalog cache; constructs and states are read
+    with one query each regardless of the number of characters.
+    """
+    try:
+        characters = {cid: character_cache.get(db, cid) for cid in character_ids}
+        found = [cid for cid, character in characters.items() if character]
+        constructs = get_constructs_for_characters(db, user_id, found, limit=CONSTRUCT_CANDIDATES)
+        likings = get_internal_state_values(db, user_id, found, "liking")
+        return characters, constructs, likings
+    finally:
+        _release_connection(db)
+
+
+def _apply_liking_scores(db: Session, user_id: UUID, scores: List[tuple[UUID, int]]) -> List[int]:
+    """Apply several liking deltas in one transaction, in order."""
+    values = [
+        _apply_liking_score(db, user_id, character_id, score, commit=False)
+        for character_id, score in scores
+    ]
+    with stage("db_commit"):
+        db.commit()
+    return values
+
+
+@router.post("/evaluate-liking/batch")
+async def evaluate_liking_batch(data: EvaluateLikingBatchRequest, db: Session = Depends(get_db)):
+    """Evaluate several (character, message) pairs for one user at once.
+
+    Intent is extracted once per distinct message and all evaluations run
+    concurrently. Every item is evaluated against the liking stored before
+    the request; the deltas are then applied in item order in a single
+    commit, so ``new_liking`` of a repeated character reflects the earlier
+    items.
+    """
+    if len(data.items) > EVAL_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"一度に評価できるのは {EVAL_BATCH_MAX_ITEMS} 件までです",
+        )
+    if not data.items:
+        return {"results": []}
+
+    character_ids = list(dict.fromkeys(item.character_id for item in data.items))
+    characters, constructs, likings = await run_in_threadpool(
+        _load_liking_batch_context, db, data.user_id, character_ids
+    )
+    missing = [str(cid) for cid in character_ids if not characters[cid]]
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"キャラクターが見つかりません: {', '.join(missing)}",
+        )
+
+    # ローカル判定で確定しない発言だけ意図抽出する
+    decisions = [
+        classify_liking(item.player_message, characters[item.character_id].liking_overrides)
+        for item in data.items
+    ]
+    messages = list(dict.fromkeys(
+        item.player_message for item, local in zip(data.items, decisions) if not local.accepted
+    ))
+    intents = dict(zip(
+        messages,
+        await asyncio.gather(*(extract_intent(m, data.user_id) for m in messages)),
+    ))
+
+    return_raw = data.debug or data.include_prompt
+    evaluations = await asyncio.gather(*(
+        evaluate_liking_character_view(
+            item.player_message,
+            characters[item.character_id],
+            constructs[item.character_id],
+            likings.get(item.character_id, 0),
+            return_raw=return_raw,
+            intent=intents.get(item.player_message),
+            user_id=data.user_id,
+            local=local,
+        )
+        for item, local in zip(data.items, decisions)
+    ))
+
+    new_likings = await run_in_threadpool(
+        _apply_liking_scores,
+        db,
+        data.user_id,
+        [(item.character_id, evaluation[0]) for item, evaluation in zip(data.items, evaluations)],
+    )
+
+    results = []
+    for item, (score, reason, intent, prompt_debug, gpt_raw, scorer), new_liking in zip(
+        data.items, evaluations, new_likings
+    ):
+        result = {
+            "character_id": item.character_id,
+            "new_liking": new_liking,
+            "score": score,
+            "reason": reason,
+            "intent": intent,
+        }
+        if data.debug:
+            result["gpt_debug"] = gpt_raw
+            result["scorer"] = scorer
+        if data.include_prompt:
+            _attach_eval_prompt(result, "prompt", prompt_debug, item.player_message, scorer)
+            result["constructs"] = selection_debug(constructs[item.character_id], intent, item.player_message)
+        results.append(result)
+    return {"results": results}
+
+
+def _save_turn(
+    db: Session,
+    user_id: UUID,
+    character_id: UUID,
+    user_message: str,
+    reply: Optional[str],
+    score: int,
+) -> int:
+    """Persist the chat rows and the liking delta of a turn in one commit."""
+    if reply is not None:
+        _save_chat_turn(db, user_id, character_id, user_message, reply, commit=False)
+    new_liking = _apply_liking_score(db, user_id, character_id, score, commit=False)
+    with stage("db_commit"):
+        db.commit()
+    return new_liking
+
+
+@router.post("/turn")
+async def turn(
+    request: TurnRequest,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    """Reply and liking evaluation for one player message in a single call.
+
+    State is loaded once and the intent is extracted once, then the reply
+    completion and the liking evaluation run concurrently. Supports
+    ``Idempotency-Key``.
+    """
+    return await _run_idempotent(
+        "turn", request, idempotency_key, response,
+        lambda: _turn(request, background_tasks, db),
+    )
+
+
+async def _turn(request: TurnRequest, background_tasks: BackgroundTasks, db: Session) -> tuple[dict, bool]:
+    history, character, state, constructs = await run_in_threadpool(
+        _load_chat_context, db, request.user_id, request.character_id
+    )
+    if not character:
+        raise HTTPException(status_code=404, detail="キャラクターが見つかりません")
+
+    messages = history.as_messages()
+    messages.append({"role": "user", "content": request.user_message})
+
+    liking_raw = state.value if state else 0
+    # ローカル判定で確定する発言は辞書の意図を使い、意図抽出の呼び出しを省く
+    local = classify_liking(request.user_message, character.liking_overrides)
+    intent = request.intent or (
+        local.intent if local.accepted else await extract_intent(request.user_message, request.user_id)
+    )
+    system_prompt = {
+        "role": "system",
+        "content": build_full_prompt(
+            character,
+            map_liking_to_level(liking_raw),
+            select_constructs(constructs, intent, request.user_message),
+            intent,
+        ),
+    }
+
+    reply_result, eval_result = await asyncio.gather(
+        generate_reply(system_prompt, messages, request.user_id, request.character_id),
+        evaluate_liking_character_view(
+            request.user_message,
+            character,
+            constructs,
+            liking_raw,
+            return_raw=request.debug or request.include_prompt,
+            intent=intent,
+            user_id=request.user_id,
+            local=local,
+        ),
+        return_exceptions=True,
+    )
+    if isinstance(eval_result, BaseException):
+        raise eval_result
+    score, reason, _, prompt_debug, eval_raw, scorer = eval_result
+
+    if isinstance(reply_result, BaseException):
+        logger.error("❌ GPT API エラー: %s", str(reply_result))
+        reply, gpt_raw = None, None
+    else:
+        reply, gpt_raw = reply_result
+
+    new_liking = await run_in_threadpool(
+        _save_turn,
+        db,
+        request.user_id,
+        request.character_id,
+        request.user_message,
+        reply,
+        score,
+    )
+    _schedule_summary_refresh(background_tasks, history, request.user_id, request.character_id)
+
+    response_data = {
+        "reply": reply if reply is not None else f"エラーが発生しました: {str(reply_result)}",
+        "score": score,
+        "reason": reason,
+        "new_liking": new_liking,
+        "intent": intent,
+    }
+    if request.debug:
+        response_data["gpt_debug"] = {"reply": gpt_raw, "liking": eval_raw, "scorer": scorer}
+    if request.include_prompt:
+        response_data["prompt"] = [system_prompt] + messages
+        _attach_eval_prompt(response_data, "eval_prompt", prompt_debug, request.user_message, scorer)
+        response_data["constructs"] = selection_debug(constructs, intent, request.user_message)
+    # 返信に失敗しても好感度は反映済みのため、結果を保存して二重適用を防ぐ
+    return response_data, True
+
+
+def _open_session(user_id: UUID, character_id: UUID) -> Optional[ConversationSession]:
+    """Load the hot state of a WebSocket session with a short-lived DB session."""
+    with SessionLocal() as db:
+        history, character, state, constructs = _load_chat_context(db, user_id, character_id)
+    if not character:
+        return None
+    return ConversationSession(
+        user_id=user_id,
+        character_id=character_id,
+        character=character,
+        liking=state.value if state else 0,
+        constructs=constructs,
+        context=history,
+    )
+
+
+def _persist_session_turn(session: ConversationSession, user_message: str, reply: str, score: Optional[int]) -> Optional[int]:
+    """Write a WebSocket turn through to the DB; returns the stored liking."""
+    with SessionLocal() as db:
+        if score is None:
+            _save_chat_turn(db, session.user_id, session.character_id, user_message, reply)
+            return None
+        return _save_turn(db, session.user_id, session.character_id, user_message, reply, score)
+
+
+async def _session_turn(websocket: WebSocket, session: ConversationSession, message: SessionMessage) -> None:
+    """Run one turn: stream the reply, evaluate liking, write through and push results."""
+    text = message.text or ""
+    local = classify_liking(text, session.character.liking_overrides)
+    intent = message.intent or (
+        local.intent if local.accepted else await extract_intent(text, session.user_id)
+    )
+    messages = session.context.as_messages()
+    messages.append({"role": "user", "content": text})
+    system_prompt = {
+        "role": "system",
+        "content": build_full_prompt(
+            session.character,
+            map_liking_to_level(session.liking),
+            select_constructs(session.constructs, intent, text),
+            intent,
+        ),
+    }
+
+    evaluation = None
+    if message.evaluate:
+        evaluation = asyncio.ensure_future(evaluate_liking_character_view(
+            text,
+            session.character,
+            session.constructs,
+            session.liking,
+            intent=intent,
+            user_id=session.user_id,
+            local=local,
+        ))
+
+    parts = []
+    meta = {}
+    try:
+        async for token in stream_reply(system_prompt, messages, session.user_id, session.character_id, meta):
+            parts.append(token)
+            await websocket.send_json({"type": "token", "token": token})
+    except Exception as e:
+        if evaluation is not None:
+            evaluation.cancel()
+        if isinstance(e, WebSocketDisconnect):
+            raise
+        logger.error("❌ GPT API エラー: %s", str(e))
+        await websocket.send_json({"type": "error", "detail": f"エラーが発生しました: {str(e)}"})
+        return
+    reply = "".join(parts)
+
+    score, reason, scorer = None, None, None
+    if evaluation is not None:
+        score, reason, _, _, _, scorer = await evaluation
+
+    new_liking = await run_in_threadpool(_persist_session_turn, session, text, reply, score)
+    session.record_turn(text, reply, new_liking)
+
+    if session.needs_resync:
+        # ウィンドウから外れた発言が溜まったら DB から読み直し、必要なら要約を更新
+        fresh = await run_in_threadpool(_open_session, session.user_id, session.character_id)
+        if fresh:
+            session.reload(fresh)
+            if session.context.refresh_until is not None:
+                _spawn_summary_refresh(session.user_id, session.character_id, session.context.refresh_until)
+
+    if score is not None:
+        liking_event = {"type": "liking", "score": score, "reason": reason, "new_liking": new_liking}
+        if message.debug:
+            liking_event["scorer"] = scorer
+        await websocket.send_json(liking_event)
+
+    done = {"type": "done", "reply": reply}
+    if message.debug:
+        done["intent"] = intent
+        done["gpt_debug"] = meta
+    await websocket.send_json(done)
+
+
+@router.websocket("/ws/{user_id}/{character_id}")
+async def conversation_session(websocket: WebSocket, user_id: UUID, character_id: UUID):
+    """Conversation over one WebSocket per (user, character).
+
+    Character, liking, constructs and recent history are loaded once on
+    connect and kept in memory; each turn streams ``token`` events, then
+    ``liking`` and ``done`` once the turn has been written to the DB.
+    Send ``{"type": "reload"}`` to re-read the state after external edits.
+    """
+    await websocket.accept()
+    session = await run_in_threadpool(_open_session, user_id, character_id)
+    if session is None:
+        await websocket.send_json({"type": "error", "detail": "キャラクターが見つかりません"})
+        await websocket.close(code=4404)
+        return
+
+    sessions.add(session)
+    try:
+        await websocket.send_json(session.ready_event())
+        while True:
+            try:
+                message = SessionMessage.model_validate_json(await websocket.receive_text())
+            except ValidationError as e:
+                await websocket.send_json({"type": "error", "detail": e.errors(include_url=False)[0]["msg"]})
+                continue
+
+            if message.type == "ping":
+                await websocket.send_json({"type": "pong"})
+            elif message.type == "reload":
+                fresh = await run_in_threadpool(_open_session, user_id, character_id)
+                if fresh:
+                    session.reload(fresh)
+                await websocket.send_json(session.ready_event())
+            elif not message.text:
+                await websocket.send_json({"type": "error", "detail": "text が空です"})
+            else:
+                await _session_turn(websocket, session, message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sessions.discard(session)
 
 
 # --------------------- Construct Endpoints ---------------------
 
-@app.post("/constructs/", response_model=List[ConstructResponse])
+@router.post("/constructs/", response_model=List[ConstructResponse])
 def create_construct_route(data: List[ConstructCreate], db: Session = Depends(get_db)):
-    constructs = create_constructs(db, data)
-    for obj, req in zip(constructs, data):
-        obj.axis = req.axis
-    return constructs
+    return create_constructs(db, data)
 
 
-@app.get("/constructs/{user_id}/{character_id}", response_model=List[ConstructResponse])
-def list_constructs_route(user_id: UUID, character_id: UUID, db: Session = Depends(get_db)):
-    constructs = get_constructs(db, user_id, character_id)
-    for c in constructs:
-        c.axis = json.loads(c.axis)
-    return constructs
+@router.get("/constructs/{user_id}/{character_id}", response_model=List[ConstructResponse])
+def list_constructs_route(
+    user_id: UUID,
+    character_id: UUID,
+    pole: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """List constructs; ``?pole=`` keeps only axes containing that pole."""
+    return get_constructs(db, user_id, character_id, pole)
 
 
-@app.delete("/constructs/{construct_id}")
+@router.delete("/constructs/{construct_id}")
 def delete_construct_route(construct_id: UUID, db: Session = Depends(get_db)):
     c = delete_construct(db, construct_id)
     if not c:
@@ -449,32 +1308,197 @@ def delete_construct_route(construct_id: UUID, db: Session = Depends(get_db)):
     return {"message": "deleted"}
 
 
-@app.post("/constructs/import")
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_MAX_ERRORS = 100
+
+
+def _import_constructs_stream(db: Session, fileobj) -> dict:
+    """Parse a JSONL upload line by line and bulk-insert it in one transaction.
+
+    Lines are validated into ``ConstructCreate`` in chunks of
+    ``IMPORT_BATCH_SIZE``; invalid lines (bad JSON, schema errors, unknown
+    user/character) are reported and skipped.
+    """
+    errors = []
+    error_count = 0
+    inserted = 0
+    known_users: set = set()
+    known_characters: set = set()
+    batch: List[tuple] = []
+
+    def report(lineno: int, message: str) -> None:
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({"line": lineno, "error": message})
+
+    def flush() -> None:
+        nonlocal inserted
+        known_users.update(existing_user_ids(db, {c.user_id for _, c in batch} - known_users))
+        known_characters.update(existing_character_ids(db, {c.character_id for _, c in batch} - known_characters))
+        valid = []
+        for lineno, construct in batch:
+            if construct.user_id not in known_users:
+                report(lineno, f"user not found: {construct.user_id}")
+            elif construct.character_id not in known_characters:
+                report(lineno, f"character not found: {construct.character_id}")
+            else:
+                valid.append(construct)
+        inserted += bulk_insert_constructs(db, valid)
+        batch.clear()
+
+    try:
+        for lineno, raw in enumerate(fileobj, start=1):
+            try:
+                line = raw.decode("utf-8-sig" if lineno == 1 else "utf-8").strip()
+                if not line:
+                    continue
+                batch.append((lineno, ConstructCreate(**json.loads(line))))
+            except ValidationError as e:
+                report(lineno, "; ".join(
+                    f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()
+                ))
+                continue
+            except (UnicodeDecodeError, json.JSONDecodeError, TypeError) as e:
+                report(lineno, str(e))
+                continue
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                flush()
+        flush()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    errors.sort(key=lambda e: e["line"])
+    return {"status": "imported", "count": inserted, "error_count": error_count, "errors": errors}
+
+
+@router.post("/constructs/import")
 async def import_constructs(file: UploadFile, db: Session = Depends(get_db)):
-    content = await file.read()
-    lines = content.decode("utf-8").splitlines()
-    for line in lines:
-        if not line.strip():
-            continue
-        data = json.loads(line)
-        create_construct(db, ConstructCreate(**data))
-    return {"status": "imported", "count": len(lines)}
-
-
-@app.get("/constructs/export/{user_id}/{character_id}")
-def export_constructs(user_id: UUID, character_id: UUID, db: Session = Depends(get_db)):
-    constructs = get_constructs(db, user_id, character_id)
-    jsonl = "\n".join(json.dumps({
+    try:
+        return await run_in_threadpool(_import_constructs_stream, db, file.file)
+    except SQLAlchemyError as e:
+        logger.exception("❌ コンストラクト一括登録エラー: %s", str(e))
+        raise HTTPException(status_code=500, detail="インポート中にエラーが発生しました")
+
+
+def _construct_export_row(c: Construct) -> dict:
+    return {
         "user_id": str(c.user_id),
         "character_id": str(c.character_id),
-        "axis": json.loads(c.axis),
+        "axis": c.axis,
         "name": c.name,
         "importance": c.importance,
         "behavior_effect": c.behavior_effect,
         "value": c.value,
-    }) for c in constructs)
-    return Response(content=jsonl, media_type="text/plain")
+    }
+
+
+def _history_export_row(h: ChatHistory) -> dict:
+    return {
+        "id": str(h.id),
+        "user_id": str(h.user_id),
+        "character_id": str(h.character_id),
+        "role": h.role,
+        "message": h.message,
+        "timestamp": h.timestamp.isoformat() if h.timestamp else None,
+    }
+
+
+@router.get("/constructs/export/{user_id}/{character_id}")
+def export_constructs(user_id: UUID, character_id: UUID, gzip: bool = False):
+    stmt = select(Construct).where(
+        Construct.user_id == user_id, Construct.character_id == character_id
+    )
+    return jsonl_response(
+        stmt, _construct_export_row, f"constructs_{user_id}_{character_id}.jsonl", compress=gzip
+    )
+
+
+@router.get("/history/export/{user_id}/{character_id}")
+def export_chat_history(user_id: UUID, character_id: UUID, gzip: bool = False):
+    stmt = select(ChatHistory).where(
+        ChatHistory.user_id == user_id, ChatHistory.character_id == character_id
+    ).order_by(ChatHistory.timestamp, ChatHistory.id)
+    return jsonl_response(
+        stmt, _history_export_row, f"history_{user_id}_{character_id}.jsonl", compress=gzip
+    )
+
+@router.get("/usage")
+def usage_summary(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    group_by: str = "call_site",
+    user_id: Optional[UUID] = None,
+    character_id: Optional[UUID] = None,
+    call_site: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db),
+):
+    """Token usage, latency and estimated cost from the hourly rollup.
+
+    ``group_by`` is a comma-separated list of user, character, call_site,
+    model, hour and day. The window defaults to the last 24 hours and is
+    widened to whole hours.
+    """
+    groups = list(dict.fromkeys(g.strip() for g in group_by.split(",") if g.strip()))
+    unknown = [g for g in groups if g not in USAGE_GROUPS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"未対応の group_by です: {', '.join(unknown)}（指定可能: {', '.join(USAGE_GROUPS)}）",
+        )
+    since, until = usage_window(since, until)
+    rows = aggregate_usage(db, since, until, groups, user_id, character_id, call_site)
+    return {
+        "since": since,
+        "until": until,
+        "group_by": groups,
+        "rows": summarize_usage(rows, groups)[:limit],
+        "ledger": usage_ledger.stats(),
+    }
+
+@router.get("/metrics")
+def metrics():
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+@router.get("/cache/intent")
+def intent_cache_stats():
+    return intent_cache.stats()
 
-@app.get("/")
+@router.get("/cache/idempotency")
+def idempotency_stats():
+    return idempotency.stats()
+
+@router.get("/")
 def root():
     return {"message": "アプリは動作中です"}
+
+
+def create_app(openai_client=None, database_url: Optional[str] = None) -> FastAPI:
+    """Build the FastAPI application.
+
+    Nothing is connected here: the engine, the OpenAI client and the caches
+    are created and warmed up in the lifespan, once per worker process.
+    ``openai_client`` and ``database_url`` override the environment, e.g.
+    for benchmarks.
+    """
+    app = FastAPI(lifespan=lifespan)
+    app.state.openai_client = openai_client
+    app.state.database_url = database_url
+
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Before", "Server-Timing"],
+    )
+    app.include_router(router)
+    return app
+
+
+app = create_app()
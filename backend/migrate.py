@@ -0,0 +1,90 @@
+from dotenv import load_dotenv
+from pathlib import Path
+
+env_path = Path('.') / '.env'
+load_dotenv(dotenv_path=env_path)
+
+from sqlalchemy import text
+
+from backend.db.database import get_engine
+from backend.models.models import Base
+
+# 既存データベース向けの追加スキーマ変更（何度実行しても安全なもののみ）
+MIGRATIONS = [
+    (
+        "chat_history の複合インデックス",
+        "CREATE INDEX IF NOT EXISTS ix_chat_history_user_character_timestamp "
+        "ON chat_history (user_id, character_id, timestamp)",
+    ),
+    (
+        "internal_states の重複行を削除（最新の行を残す）",
+        "DELETE FROM internal_states a USING internal_states b "
+        "WHERE a.user_id = b.user_id AND a.character_id = b.character_id "
+        "AND a.param_name = b.param_name "
+        "AND (a.updated_at, a.id) < (b.updated_at, b.id)",
+    ),
+    (
+        "internal_states の一意制約",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_internal_states_user_character_param "
+        "ON internal_states (user_id, character_id, param_name)",
+    ),
+    (
+        "characters.liking_overrides 列の追加",
+        "ALTER TABLE characters ADD COLUMN IF NOT EXISTS liking_overrides TEXT",
+    ),
+    # JSON 文字列の Text 列を JSONB へ変換（既存行の値もそのまま変換。空文字は NULL 扱い）
+    *(
+        (
+            f"characters.{column} を JSONB へ変換",
+            f"ALTER TABLE characters ALTER COLUMN {column} TYPE JSONB "
+            f"USING CASE WHEN {column}::text = '' THEN NULL ELSE {column}::text::jsonb END",
+        )
+        for column in ("prohibited", "examples", "liking_overrides")
+    ),
+    (
+        "constructs.axis を JSONB へ変換",
+        "ALTER TABLE constructs ALTER COLUMN axis TYPE JSONB USING axis::text::jsonb",
+    ),
+    (
+        "constructs.axis の GIN インデックス",
+        "CREATE INDEX IF NOT EXISTS ix_constructs_axis ON constructs USING gin (axis)",
+    ),
+    (
+        "constructs の (user_id, character_id, importance) インデックス",
+        "CREATE INDEX IF NOT EXISTS ix_constructs_user_character_importance "
+        "ON constructs (user_id, character_id, importance)",
+    ),
+    # 発言検索用: 小文字化した本文の 1 文字・2 文字 n-gram 配列を GIN で索引化する。
+    # 分かち書きのない日本語の 1〜2 文字の語（猫・約束など）でも、ロケールに関係なく索引が効く
+    (
+        "chat_ngrams 関数の作成",
+        "CREATE OR REPLACE FUNCTION chat_ngrams(t text) RETURNS text[] "
+        "LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$ "
+        "SELECT coalesce(array_agg(DISTINCT g), '{}') FROM ("
+        "SELECT substr(lower(t), i, 1) FROM generate_series(1, char_length(t)) AS i "
+        "UNION ALL "
+        "SELECT substr(lower(t), i, 2) FROM generate_series(1, char_length(t) - 1) AS i"
+        ") AS grams(g) $$",
+    ),
+    (
+        "chat_history.message の n-gram GIN インデックス",
+        "CREATE INDEX IF NOT EXISTS ix_chat_history_message_ngrams "
+        "ON chat_history USING gin (chat_ngrams(message))",
+    ),
+]
+
+
+def run_migrations() -> None:
+    # 新規テーブルは create_all で作成し、既存テーブルへの変更は MIGRATIONS で適用
+    engine = get_engine()
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for label, statement in MIGRATIONS:
+            print(f"🔧 {label}")
+            conn.execute(text(statement))
+
+
+if __name__ == "__main__":
+    print("🔧 マイグレーションを実行中...")
+    run_migrations()
+    print("✅ マイグレーション完了！")
@@ -1,12 +1,16 @@
 import uuid
-from sqlalchemy import Column, String, Text, ForeignKey, DateTime, Integer, Float
+from datetime import datetime, timezone
+from sqlalchemy import JSON, BigInteger, Column, String, Text, ForeignKey, DateTime, Integer, Float, Index, UniqueConstraint
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.sql import func
-from sqlalchemy.dialects.postgresql import UUID  # PostgreSQL用UUID型
+from sqlalchemy.dialects.postgresql import JSONB, UUID  # PostgreSQL用UUID型・JSONB型
 
 # ✅ SQLAlchemyのベースモデル
 Base = declarative_base()
 
+# ✅ JSON列（PostgreSQL では JSONB、その他の DB では JSON。None は SQL の NULL として保存）
+JSONType = JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql")
+
 # 🧠 キャラクター情報（AIの人格設定など）
 class Character(Base):
     __tablename__ = "characters"
@@ -34,13 +38,17 @@ class Character(Base):
     # 世界観（キャラクターが属する物語世界や時代背景など）
     world = Column(Text, nullable=True)
 
-    # 禁止事項リスト（JSON文字列で保存）
-    # 例: '["現実世界の話をしない", "攻撃的な発言をしない"]'
-    prohibited = Column(Text, nullable=True)
+    # 禁止事項リスト
+    # 例: ["現実世界の話をしない", "攻撃的な発言をしない"]
+    prohibited = Column(JSONType, nullable=True)
+
+    # 対話例（ユーザーとキャラクターの例会話）
+    # 例: [{"user": "こんにちは", "assistant": "やあ、よく来たね"}]
+    examples = Column(JSONType, nullable=True)
 
-    # 対話例（ユーザーとキャラクターの例会話をJSONで保存）
-    # 例: '[{"user": "こんにちは", "assistant": "やあ、よく来たね"}]'
-    examples = Column(Text, nullable=True)
+    # 好感度のローカル判定で優先する定型句とスコア
+    # 例: {"ばか": 1, "ありがとう": 2}
+    liking_overrides = Column(JSONType, nullable=True)
 
     # Big Five スコア
     openness = Column(Float, nullable=False, default=0.5)
@@ -75,7 +83,19 @@ class ChatHistory(Base):
     message = Column(Text, nullable=False)
 
     # 発言タイムスタンプ
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # 同一トランザクション内の発言（ユーザー→キャラ）でも順序が付くようアプリ側で付与
+    timestamp = Column(
+        DateTime(timezone=True),
+        default=lambda: datetime.now(timezone.utc),
+        server_default=func.now(),
+    )
+
+    # (ユーザー, キャラ) ごとの時系列取得・ページングを索引で解決する
+    # 発言検索用の n-gram GIN インデックス（ix_chat_history_message_ngrams）は
+    # SQL 関数 chat_ngrams が必要なため backend/migrate.py で作成する
+    __table_args__ = (
+        Index("ix_chat_history_user_character_timestamp", "user_id", "character_id", "timestamp"),
+    )
 
 # 🔧 内部状態（好感度などの内部パラメータ）を管理
 class InternalState(Base):
@@ -98,6 +118,17 @@ class InternalState(Base):
     # 最終更新日時（自動更新）
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
+    # 1ユーザー×1キャラ×1パラメータにつき1行（ON CONFLICT による加算更新の対象）
+    __table_args__ = (
+        Index(
+            "uq_internal_states_user_character_param",
+            "user_id",
+            "character_id",
+            "param_name",
+            unique=True,
+        ),
+    )
+
 # 🏷️ 価値軸（コンストラクト）
 class Construct(Base):
     """User specific value axis for a character."""
@@ -112,8 +143,8 @@ class Construct(Base):
     # 関連キャラクター
     character_id = Column(UUID(as_uuid=True), ForeignKey("characters.id"), nullable=False)
 
-    # 軸の両極値ペアをJSON文字列で保持
-    axis = Column(Text, nullable=False)
+    # 軸の両極値ペア（例: ["慎重", "大胆"]）
+    axis = Column(JSONType, nullable=False)
 
     # 軸の名称
     name = Column(String, nullable=False)
@@ -126,3 +157,152 @@ class Construct(Base):
 
     # 値（-5～+5 程度を想定）
     value = Column(Integer, default=0)
+
+    # 極値（axis の要素）による絞り込み用。PostgreSQL では GIN 索引（@> 演算子）
+    __table_args__ = (
+        Index("ix_constructs_axis", "axis", postgresql_using="gin"),
+        # プロンプト用の候補を重要度順に取得する
+        Index("ix_constructs_user_character_importance", "user_id", "character_id", "importance"),
+    )
+
+# 🗂️ 意図抽出キャッシュ（正規化済み発言 → 意図）
+class IntentCacheEntry(Base):
+    __tablename__ = "intent_cache"
+
+    # 正規化済みの発言（NFKC・句読点除去済み）
+    key = Column(String, primary_key=True)
+
+    # 抽出された意図
+    intent = Column(Text, nullable=False)
+
+    # 登録日時（TTL 判定に使用）
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# 📝 会話の要約（コンテキストから外れた古い発言を要約して保持）
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summaries"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+
+    # 対象ユーザー
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
+
+    # 対象キャラクター
+    character_id = Column(UUID(as_uuid=True), ForeignKey("characters.id"), nullable=False)
+
+    # 要約本文
+    summary = Column(Text, nullable=False, default="")
+
+    # 要約に含めた最後の発言のタイムスタンプ
+    summarized_until = Column(DateTime(timezone=True), nullable=True)
+
+    # 要約に含めた発言数（累計）
+    message_count = Column(Integer, nullable=False, default=0)
+
+    # 最終更新日時
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "character_id", name="uq_conversation_summaries_user_character"),
+    )
+
+# 🔢 キャッシュのバージョン番号（ワーカー間でのキャッシュ無効化に使用）
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+
+    # キャッシュ名（例："characters"）
+    name = Column(String, primary_key=True)
+
+    # 更新のたびに加算されるバージョン番号
+    version = Column(Integer, nullable=False, default=0)
+
+# 💰 OpenAI 呼び出しごとのトークン使用量（追記のみの台帳）
+class LLMUsage(Base):
+    __tablename__ = "llm_usage"
+
+    # 大量の追記に備えて連番（SQLite では INTEGER PRIMARY KEY の自動採番）
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+
+    # 呼び出し完了日時
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    # 対象ユーザー・キャラクター（意図抽出などキャラに紐づかない呼び出しは NULL）
+    user_id = Column(UUID(as_uuid=True), nullable=True)
+    character_id = Column(UUID(as_uuid=True), nullable=True)
+
+    # 呼び出し箇所（"intent", "eval", "reply", "reply_stream", "summary" など）
+    call_site = Column(String, nullable=False)
+
+    # 指定したモデル名
+    model = Column(String, nullable=False)
+
+    # トークン数
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+
+    # 所要時間（待ち行列・再試行を含む。ミリ秒）
+    latency_ms = Column(Float, nullable=False, default=0)
+
+    # 結果（"ok" または "error"）
+    outcome = Column(String, nullable=False, default="ok")
+
+    __table_args__ = (
+        Index("ix_llm_usage_created_at", "created_at"),
+        Index("ix_llm_usage_user_created_at", "user_id", "created_at"),
+        Index("ix_llm_usage_character_created_at", "character_id", "created_at"),
+    )
+
+# 📊 トークン使用量の1時間ごとの集計（llm_usage と同じトランザクションで加算）
+class LLMUsageHourly(Base):
+    __tablename__ = "llm_usage_hourly"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+
+    # 集計区間の開始（UTC、時単位に切り捨て）
+    bucket = Column(DateTime(timezone=True), nullable=False)
+
+    # 集計キー（紐づかない場合は Max UUID。NULL だと一意制約で重複するため）
+    user_id = Column(UUID(as_uuid=True), nullable=False)
+    character_id = Column(UUID(as_uuid=True), nullable=False)
+    call_site = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+
+    # 集計値
+    calls = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    completion_tokens = Column(BigInteger, nullable=False, default=0)
+    latency_ms = Column(Float, nullable=False, default=0)
+
+    __table_args__ = (
+        Index(
+            "uq_llm_usage_hourly_key",
+            "bucket", "user_id", "character_id", "call_site", "model",
+            unique=True,
+        ),
+        Index("ix_llm_usage_hourly_user_bucket", "user_id", "bucket"),
+        Index("ix_llm_usage_hourly_character_bucket", "character_id", "bucket"),
+    )
+
+# 🔁 Idempotency-Key ごとの処理結果（再送時に同じレスポンスを返す）
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_keys"
+
+    # エンドポイント・ユーザー・Idempotency-Key を連結したキー
+    key = Column(String, primary_key=True)
+
+    # リクエスト本文のハッシュ（同じキーで内容が異なる再送を検出）
+    request_hash = Column(String, nullable=False)
+
+    # 処理状態（"pending" 処理中 / "done" 完了）
+    status = Column(String, nullable=False, default="pending")
+
+    # 完了時のレスポンス本文
+    response = Column(JSONType, nullable=True)
+
+    # 受付日時（保持期間の判定に使用）
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_idempotency_keys_created_at", "created_at"),
+    )
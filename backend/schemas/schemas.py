@@ -15,6 +15,7 @@ class CharacterCreate(BaseModel):
     world: Optional[str] = None               # 世界観（どんな世界にいるキャラか）
     prohibited: Optional[List[str]] = None    # 禁止事項（文字列のリスト）
     examples: Optional[List[Dict[str, str]]] = None  # 対話例（{"user": "...", "assistant": "..."} のリスト）
+    liking_overrides: Optional[Dict[str, int]] = None  # 好感度のローカル判定用の定型句（{"定型句": スコア}）
 
     # Big Five スコア
     openness: float = 0.5
@@ -36,6 +37,7 @@ class CharacterResponse(BaseModel):
     world: Optional[str] = None
     prohibited: Optional[List[str]] = None
     examples: Optional[List[Dict[str, str]]] = None
+    liking_overrides: Optional[Dict[str, int]] = None
 
     # Big Five スコア
     openness: float
@@ -58,6 +60,7 @@ class CharacterUpdate(BaseModel):
     world: Optional[str] = None
     prohibited: Optional[List[str]] = None
     examples: Optional[List[Dict[str, str]]] = None
+    liking_overrides: Optional[Dict[str, int]] = None
 
     # Big Five スコア（更新用）
     openness: Optional[float] = None
@@ -75,6 +78,23 @@ class ChatRequest(BaseModel):
     debug: Optional[bool] = False
     include_prompt: Optional[bool] = False
 
+# 🔸 1つの発言を複数キャラに同時に届けるグループ会話用リクエスト
+class GroupChatRequest(BaseModel):
+    user_id: UUID
+    character_ids: List[UUID]
+    user_message: str
+    intent: Optional[str] = None
+    debug: Optional[bool] = False
+    include_prompt: Optional[bool] = False
+
+# 🔸 WebSocket 会話セッションでクライアントから届くメッセージ
+class SessionMessage(BaseModel):
+    type: Literal["message", "reload", "ping"] = "message"
+    text: Optional[str] = None
+    intent: Optional[str] = None
+    evaluate: bool = True
+    debug: Optional[bool] = False
+
 # 🔸 会話履歴保存用リクエスト（UUID対応）
 class ChatMessage(BaseModel):
     user_id: UUID
@@ -102,6 +122,26 @@ class EvaluateLikingRequest(BaseModel):
     debug: Optional[bool] = False
     include_prompt: Optional[bool] = False
 
+# 🔸 複数キャラ・複数発言の好感度をまとめて評価するバッチ用リクエスト
+class EvaluateLikingBatchItem(BaseModel):
+    character_id: UUID
+    player_message: str
+
+class EvaluateLikingBatchRequest(BaseModel):
+    user_id: UUID
+    items: List[EvaluateLikingBatchItem]
+    debug: Optional[bool] = False
+    include_prompt: Optional[bool] = False
+
+# 🔸 返答生成＋好感度評価を1回で行うターン用リクエスト
+class TurnRequest(BaseModel):
+    user_id: UUID
+    character_id: UUID
+    user_message: str
+    intent: Optional[str] = None
+    debug: Optional[bool] = False
+    include_prompt: Optional[bool] = False
+
 # ✅ コンストラクト関連
 class ConstructBase(BaseModel):
     user_id: UUID
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+from uuid import UUID
+
+from sqlalchemy.orm import Session
+
+from backend.crud.crud import bump_cache_version, get_all_characters, get_cache_version
+from backend.schemas.schemas import CharacterResponse
+
+# ✅ DB 上のバージョン番号を確認する間隔（秒）。この間はDBに問い合わせない
+CHARACTER_CACHE_CHECK_INTERVAL = float(os.getenv("CHARACTER_CACHE_CHECK_INTERVAL", "2.0"))
+
+CACHE_NAME = "characters"
+
+
+def to_character_response(character) -> CharacterResponse:
+    """Convert an ORM Character to its response model."""
+    return CharacterResponse.model_validate(character)
+
+
+class CharacterCache:
+    """Process-local character catalog, versioned through ``cache_versions``.
+
+    Characters only change through the admin routes, which bump the
+    version row. Each worker re-reads that row at most every
+    ``check_interval`` seconds and reloads the catalog when it moved.
+    """
+
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        self._characters: List[CharacterResponse] = []
+        self._by_id: Dict[UUID, CharacterResponse] = {}
+        self._body = b"[]"
+        self._etag = ""
+
+    def _ensure_fresh(self, db: Session, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and self._version is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if not force and self._version is not None and now - self._checked_at < self.check_interval:
+                return
+            version = get_cache_version(db, CACHE_NAME)
+            if version != self._version:
+                self._load(db, version)
+            self._checked_at = now
+
+    def _load(self, db: Session, version: int) -> None:
+        characters = [to_character_response(c) for c in get_all_characters(db)]
+        body = json.dumps(
+            [c.model_dump(mode="json") for c in characters], ensure_ascii=False
+        ).encode("utf-8")
+        self._characters = characters
+        self._by_id = {c.id: c for c in characters}
+        self._body = body
+        self._etag = f'W/"{hashlib.sha1(body).hexdigest()[:16]}"'
+        self._version = version
+
+    def catalog(self, db: Session) -> tuple[bytes, str]:
+        """Return the serialized catalog and its ETag."""
+        self._ensure_fresh(db)
+        return self._body, self._etag
+
+    def characters(self, db: Session) -> List[CharacterResponse]:
+        self._ensure_fresh(db)
+        return self._characters
+
+    def get(self, db: Session, character_id: UUID) -> Optional[CharacterResponse]:
+        self._ensure_fresh(db)
+        character = self._by_id.get(character_id)
+        if character is None:
+            # 他ワーカーで作成された直後かもしれないので、見つからない場合はバージョンを確認し直す
+            self._ensure_fresh(db, force=True)
+            character = self._by_id.get(character_id)
+        return character
+
+    def bump(self, db: Session) -> None:
+        """Advance the shared version so every worker reloads; the caller commits."""
+        bump_cache_version(db, CACHE_NAME)
+
+    def invalidate(self) -> None:
+        """Drop this worker's copy; call after the change has been committed."""
+        with self._lock:
+            self._version = None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+character_cache = CharacterCache(check_interval=CHARACTER_CACHE_CHECK_INTERVAL)
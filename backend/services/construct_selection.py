@@ -0,0 +1,96 @@
+import os
+import unicodedata
+from typing import Iterable, List, Optional, Set, Tuple
+
+from backend.services.context import estimate_tokens
+from backend.services.prompts import format_construct
+
+# ✅ 設定（環境変数で調整可能）
+# プロンプトに含めるコンストラクトの最大数とトークン予算
+CONSTRUCT_TOP_K = int(os.getenv("CONSTRUCT_TOP_K", "8"))
+CONSTRUCT_TOKEN_BUDGET = int(os.getenv("CONSTRUCT_TOKEN_BUDGET", "400"))
+# DB から重要度順に読み込む候補数（この中から関連度で選ぶ）
+CONSTRUCT_CANDIDATES = int(os.getenv("CONSTRUCT_CANDIDATES", "50"))
+
+# スコアの重み: 重要度・値の強さ・発言/意図との語彙の重なり
+WEIGHT_IMPORTANCE = 1.0
+WEIGHT_VALUE = 0.5
+WEIGHT_OVERLAP = 6.0
+# 共有するバイグラムがこの数に達したら重なりを満点とみなす（おおよそ1語分）
+OVERLAP_SATURATION = 2
+
+
+def _bigrams(text: str) -> Set[str]:
+    """Character bigrams of the normalized text (works without a tokenizer)."""
+    folded = "".join(
+        ch for ch in unicodedata.normalize("NFKC", text).casefold()
+        if ch.isalnum()
+    )
+    if len(folded) < 2:
+        return {folded} if folded else set()
+    return {folded[i:i + 2] for i in range(len(folded) - 1)}
+
+
+def _construct_terms(c) -> Set[str]:
+    axis = c.axis or []
+    return _bigrams(" ".join([c.name or "", *axis, c.behavior_effect or ""]))
+
+
+def score_construct(c, query: Set[str]) -> float:
+    """Relevance of one construct: importance, |value| and overlap with ``query``."""
+    overlap = 0.0
+    if query:
+        overlap = min(len(_construct_terms(c) & query), OVERLAP_SATURATION) / OVERLAP_SATURATION
+    return (
+        WEIGHT_IMPORTANCE * (c.importance or 0)
+        + WEIGHT_VALUE * abs(c.value or 0)
+        + WEIGHT_OVERLAP * overlap
+    )
+
+
+def rank_constructs(constructs: Iterable, *texts: Optional[str]) -> List[Tuple[object, float]]:
+    """Constructs paired with their score, best first."""
+    query: Set[str] = set()
+    for text in texts:
+        if text:
+            query |= _bigrams(text)
+    ranked = [(c, score_construct(c, query)) for c in constructs]
+    # 同点は元の順序（重要度順）を保つ
+    ranked.sort(key=lambda pair: pair[1], reverse=True)
+    return ranked
+
+
+def select_constructs(
+    constructs,
+    *texts: Optional[str],
+    top_k: int = CONSTRUCT_TOP_K,
+    token_budget: int = CONSTRUCT_TOKEN_BUDGET,
+) -> list:
+    """Pick the top ``top_k`` constructs that fit ``token_budget`` for a prompt.
+
+    ``texts`` are the player message and/or extracted intent used for the
+    lexical-overlap part of the score.
+    """
+    if not constructs:
+        return []
+    selected = []
+    used = 0
+    for c, _ in rank_constructs(constructs, *texts):
+        if len(selected) >= top_k:
+            break
+        cost = estimate_tokens(format_construct(c))
+        if selected and used + cost > token_budget:
+            continue
+        selected.append(c)
+        used += cost
+    return selected
+
+
+def selection_debug(constructs, *texts: Optional[str]) -> List[dict]:
+    """The chosen constructs with their scores, for ``include_prompt`` output."""
+    chosen = {id(c) for c in select_constructs(constructs, *texts)}
+    return [
+        {"id": str(c.id) if getattr(c, "id", None) else None, "name": c.name, "score": round(score, 3)}
+        for c, score in rank_constructs(constructs, *texts)
+        if id(c) in chosen
+    ]
@@ -0,0 +1,195 @@
+import logging
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from backend.crud.crud import history_sort_key
+from backend.db.database import SessionLocal
+from backend.models.models import ChatHistory, ConversationSummary
+from backend.services.history_writer import history_writer
+
+logger = logging.getLogger(__name__)
+
+# ✅ 設定（環境変数で調整可能）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "40"))
+SUMMARY_REFRESH_MESSAGES = int(os.getenv("SUMMARY_REFRESH_MESSAGES", "10"))
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "200"))
+
+SUMMARY_SYSTEM_PROMPT = (
+    "あなたは会話ログの要約アシスタントです。これまでの要約と新しいやり取りを統合し、"
+    "ユーザーとキャラクターの関係・重要な出来事・約束・ユーザーの好みが分かるように"
+    "300文字以内の日本語で要約してください。要約本文のみを出力してください。"
+)
+
+# 要約更新中の (user_id, character_id)。同じ組の多重実行を防ぐ
+_refreshing: set = set()
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: ~4 ASCII chars per token, ~1 token per other char."""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars) + 4
+
+
+@dataclass
+class ConversationContext:
+    """History selected for a prompt plus the rolling summary of older turns."""
+
+    messages: List[dict] = field(default_factory=list)
+    summary: Optional[str] = None
+    # 要約の更新が必要な場合、要約に含めるべき範囲の上限（ウィンドウ最古の発言時刻）
+    refresh_until: Optional[datetime] = None
+
+    def as_messages(self) -> List[dict]:
+        if not self.summary:
+            return list(self.messages)
+        summary_message = {"role": "system", "content": f"【これまでの会話の要約】\n{self.summary}"}
+        return [summary_message] + self.messages
+
+    def append_turn(self, user_message: str, reply: str, token_budget: int = CONTEXT_TOKEN_BUDGET) -> int:
+        """Add a turn to the window and drop the oldest messages beyond the budget.
+
+        Returns how many messages fell out of the window.
+        """
+        self.messages.append({"role": "user", "content": user_message})
+        self.messages.append({"role": "assistant", "content": reply})
+        budget = token_budget - (estimate_tokens(self.summary) if self.summary else 0)
+        used = sum(estimate_tokens(m["content"]) for m in self.messages)
+        dropped = 0
+        while len(self.messages) > 2 and (used > budget or len(self.messages) > CONTEXT_MAX_MESSAGES):
+            used -= estimate_tokens(self.messages.pop(0)["content"])
+            dropped += 1
+        return dropped
+
+
+def load_context(
+    db: Session,
+    user_id,
+    character_id,
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> ConversationContext:
+    """Select the most recent turns that fit ``token_budget``.
+
+    Turns that fall outside the window are represented by the stored
+    summary; ``refresh_until`` is set once enough of them have accumulated
+    since the last summary refresh.
+    """
+    summary = db.query(ConversationSummary).filter_by(
+        user_id=user_id, character_id=character_id
+    ).first()
+    budget = token_budget
+    if summary and summary.summary:
+        budget -= estimate_tokens(summary.summary)
+
+    candidates = db.query(ChatHistory).filter(
+        ChatHistory.user_id == user_id,
+        ChatHistory.character_id == character_id,
+    ).order_by(ChatHistory.timestamp.desc()).limit(CONTEXT_MAX_MESSAGES).all()
+    pending = history_writer.pending_for(user_id, character_id)
+    if pending:
+        seen = {h.id for h in candidates}
+        candidates = sorted(
+            candidates + [p for p in pending if p.id not in seen],
+            key=history_sort_key,
+            reverse=True,
+        )[:CONTEXT_MAX_MESSAGES]
+
+    window = []
+    used = 0
+    for h in candidates:
+        cost = estimate_tokens(h.message)
+        if window and used + cost > budget:
+            break
+        window.append(h)
+        used += cost
+    window.reverse()
+
+    context = ConversationContext(
+        messages=[{"role": h.role, "content": h.message} for h in window],
+        summary=summary.summary if summary and summary.summary else None,
+    )
+
+    # 予算で切れた場合に加え、候補数の上限（CONTEXT_MAX_MESSAGES）で切れた場合も
+    # ウィンドウより古い発言が残っているので、要約の更新対象になる
+    truncated = len(window) < len(candidates) or len(candidates) >= CONTEXT_MAX_MESSAGES
+    if window and truncated:
+        window_start = window[0].timestamp
+        pending = db.query(ChatHistory).filter(
+            ChatHistory.user_id == user_id,
+            ChatHistory.character_id == character_id,
+            ChatHistory.timestamp < window_start,
+        )
+        if summary and summary.summarized_until:
+            pending = pending.filter(ChatHistory.timestamp > summary.summarized_until)
+        if pending.limit(SUMMARY_REFRESH_MESSAGES).count() >= SUMMARY_REFRESH_MESSAGES:
+            context.refresh_until = window_start
+    return context
+
+
+def _load_unsummarized(user_id, character_id, until: datetime):
+    with SessionLocal() as db:
+        summary = db.query(ConversationSummary).filter_by(
+            user_id=user_id, character_id=character_id
+        ).first()
+        query = db.query(ChatHistory).filter(
+            ChatHistory.user_id == user_id,
+            ChatHistory.character_id == character_id,
+            ChatHistory.timestamp < until,
+        )
+        if summary and summary.summarized_until:
+            query = query.filter(ChatHistory.timestamp > summary.summarized_until)
+        rows = query.order_by(ChatHistory.timestamp.asc()).limit(SUMMARY_BATCH_MESSAGES).all()
+        previous = summary.summary if summary else ""
+        return previous, [(h.role, h.message, h.timestamp) for h in rows]
+
+
+def _store_summary(user_id, character_id, text: str, summarized_until: datetime, folded: int) -> None:
+    with SessionLocal() as db:
+        summary = db.query(ConversationSummary).filter_by(
+            user_id=user_id, character_id=character_id
+        ).first()
+        if summary is None:
+            summary = ConversationSummary(user_id=user_id, character_id=character_id, message_count=0)
+            db.add(summary)
+        summary.summary = text
+        summary.summarized_until = summarized_until
+        summary.message_count = (summary.message_count or 0) + folded
+        db.commit()
+
+
+async def refresh_summary(llm, user_id, character_id, until: datetime) -> None:
+    """Fold turns older than ``until`` into the rolling summary (background task)."""
+    key = (user_id, character_id)
+    if key in _refreshing:
+        return
+    _refreshing.add(key)
+    try:
+        previous, rows = await run_in_threadpool(_load_unsummarized, user_id, character_id, until)
+        if not rows:
+            return
+        transcript = "\n".join(
+            f"{'ユーザー' if role == 'user' else 'キャラ'}: {message}" for role, message, _ in rows
+        )
+        response = await llm.chat_completion(
+            "summary",
+            user_id=user_id,
+            character_id=character_id,
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": f"【これまでの要約】\n{previous or 'なし'}\n\n【新しいやり取り】\n{transcript}"},
+            ],
+            temperature=0.3,
+            max_tokens=300,
+        )
+        text = response.choices[0].message.content.strip()
+        await run_in_threadpool(_store_summary, user_id, character_id, text, rows[-1][2], len(rows))
+    except Exception as e:
+        logger.error("❌ 会話要約エラー: %s", str(e))
+    finally:
+        _refreshing.discard(key)
@@ -0,0 +1,43 @@
+import json
+import os
+import zlib
+from typing import Callable, Iterator
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select
+
+from backend.db.database import SessionLocal
+
+# ✅ 一度に DB から取り出す行数（サーバーサイドカーソルのフェッチ単位）
+EXPORT_YIELD_PER = int(os.getenv("EXPORT_YIELD_PER", "1000"))
+
+
+def stream_jsonl(stmt: Select, serialize: Callable, compress: bool = False) -> Iterator[bytes]:
+    """Yield ``stmt``'s rows as JSONL chunks, optionally gzip-compressed.
+
+    Rows are fetched ``EXPORT_YIELD_PER`` at a time through a server-side
+    cursor on its own session, so memory use does not grow with the
+    result size and the request's session may already be closed.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31: gzip 形式
+    with SessionLocal() as db:
+        result = db.execute(stmt.execution_options(yield_per=EXPORT_YIELD_PER)).scalars()
+        for rows in result.partitions():
+            chunk = "".join(json.dumps(serialize(row)) + "\n" for row in rows).encode("utf-8")
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+def jsonl_response(stmt: Select, serialize: Callable, filename: str, compress: bool = False) -> StreamingResponse:
+    """Wrap ``stream_jsonl`` in a download response."""
+    if compress:
+        filename += ".gz"
+    return StreamingResponse(
+        stream_jsonl(stmt, serialize, compress),
+        media_type="application/gzip" if compress else "text/plain",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
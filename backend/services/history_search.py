@@ -0,0 +1,46 @@
+import os
+import re
+from typing import List, Tuple
+
+# ✅ 設定（環境変数で調整可能）
+# 並べ替えの対象にする一致件数（新しい順）。よく出る語でも検索時間を一定に保つ
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "1000"))
+# スニペットの文字数
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "80"))
+# 検索語の最大数と検索文字列の最大長
+SEARCH_MAX_TERMS = 5
+SEARCH_MAX_QUERY_CHARS = 100
+
+_ELLIPSIS = "…"
+
+
+def parse_query(query: str) -> List[str]:
+    """Split a search string on whitespace into distinct terms (all must match)."""
+    return list(dict.fromkeys(query.split()))[:SEARCH_MAX_TERMS]
+
+
+def make_snippet(message: str, terms: List[str], width: int = SEARCH_SNIPPET_CHARS) -> Tuple[str, List[List[int]]]:
+    """Cut ``width`` characters around the first match and locate every match in it.
+
+    Returns the snippet (with "…" where the message was cut) and the
+    ``[start, end)`` offsets of the matched terms inside the snippet.
+    """
+    pattern = re.compile(
+        "|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)),
+        re.IGNORECASE,
+    )
+    matches = list(pattern.finditer(message))
+    first = matches[0].start() if matches else 0
+    start = max(0, first - width // 3)
+    end = min(len(message), start + width)
+    start = max(0, end - width)
+
+    prefix = _ELLIPSIS if start > 0 else ""
+    suffix = _ELLIPSIS if end < len(message) else ""
+    shift = len(prefix) - start
+    highlights = [
+        [m.start() + shift, m.end() + shift]
+        for m in matches
+        if m.start() >= start and m.end() <= end
+    ]
+    return prefix + message[start:end] + suffix, highlights
@@ -0,0 +1,231 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, InterfaceError, OperationalError
+
+from backend.db.database import SessionLocal
+from backend.models.models import ChatHistory
+from backend.services.metrics import CallbackCounter, Gauge, register
+
+logger = logging.getLogger(__name__)
+
+# ✅ 設定（環境変数で調整可能）
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "").lower() in ("1", "true", "yes")
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", "10000"))
+HISTORY_FLUSH_SIZE = int(os.getenv("HISTORY_FLUSH_SIZE", "200"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+# キューが満杯のとき: "sync" は即座に同期書き込み、"block" は空きを待ってから（時間切れなら同期書き込み）
+HISTORY_QUEUE_FULL_POLICY = os.getenv("HISTORY_QUEUE_FULL_POLICY", "sync")
+HISTORY_BLOCK_TIMEOUT = float(os.getenv("HISTORY_BLOCK_TIMEOUT", "1.0"))
+
+# 行の内容が原因のエラー（存在しない user_id など）。再試行しても成功しない
+_ROW_ERRORS = (IntegrityError, DataError)
+
+
+def _is_transient(error: Exception) -> bool:
+    """Connection-level failures, after which the same rows may succeed."""
+    if isinstance(error, (OperationalError, InterfaceError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+def make_history_row(user_id, character_id, role: str, message: str) -> dict:
+    """Build a ChatHistory row with id and timestamp assigned up front."""
+    return {
+        "id": uuid.uuid4(),
+        "user_id": user_id,
+        "character_id": character_id,
+        "role": role,
+        "message": message,
+        "timestamp": datetime.now(timezone.utc),
+    }
+
+
+class HistoryWriter:
+    """In-process write-behind buffer for ChatHistory rows.
+
+    Rows are appended to a bounded buffer and bulk-inserted by a background
+    thread when ``flush_size`` rows are pending or ``flush_interval``
+    seconds have passed. Rows not yet committed stay visible through
+    ``pending_for`` so history reads do not miss them.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        max_size: int,
+        flush_size: int,
+        flush_interval: float,
+        full_policy: str = "sync",
+        block_timeout: float = 1.0,
+    ):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.full_policy = full_policy
+        self.block_timeout = block_timeout
+        self._buffer: List[dict] = []
+        self._inflight: List[dict] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.flushed = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if not self.enabled or self.running:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+        logger.info("✅ 履歴の遅延書き込みを開始しました")
+
+    def stop(self) -> None:
+        """Stop the flusher and write everything still buffered."""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        self._flush_all()
+
+    def enqueue(self, rows: List[dict]) -> bool:
+        """Buffer ``rows``; returns False when the caller must write them itself."""
+        if not self.running:
+            return False
+        with self._cond:
+            if len(self._buffer) + len(rows) > self.max_size:
+                if self.full_policy != "block":
+                    return False
+                deadline = time.monotonic() + self.block_timeout
+                while len(self._buffer) + len(rows) > self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.running:
+                        logger.warning("⚠️ 履歴キューが満杯のため同期書き込みにフォールバックします")
+                        return False
+                    self._cond.wait(remaining)
+            self._buffer.extend(rows)
+            if len(self._buffer) >= self.flush_size:
+                self._cond.notify_all()
+        return True
+
+    def pending_for(self, user_id, character_id) -> List[ChatHistory]:
+        """Rows for the pair that may not be committed yet, as transient ChatHistory objects."""
+        if not self.enabled:
+            return []
+        with self._cond:
+            rows = [
+                r for r in self._inflight + self._buffer
+                if r["user_id"] == user_id and r["character_id"] == character_id
+            ]
+        return [ChatHistory(**r) for r in rows]
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._buffer) < self.flush_size:
+                    self._cond.wait(self.flush_interval)
+                if self._stopping:
+                    return
+                if not self._buffer:
+                    continue
+                self._inflight = self._buffer[:self.flush_size]
+                self._buffer = self._buffer[self.flush_size:]
+                # 空きができたので block ポリシーで待っている書き込みを起こす
+                self._cond.notify_all()
+            self._flush(self._inflight)
+
+    def _flush(self, rows: List[dict]) -> None:
+        try:
+            remaining = self._write(rows)
+            if remaining:
+                with self._cond:
+                    # 書き戻せる分だけキューの先頭に戻し、入りきらない分は破棄
+                    room = max(self.max_size - len(self._buffer), 0)
+                    self._buffer = remaining[:room] + self._buffer
+                    if len(remaining) > room:
+                        self.dropped += len(remaining) - room
+                        logger.error("❌ 履歴 %d 件を破棄しました", len(remaining) - room)
+                time.sleep(self.flush_interval)
+        finally:
+            with self._cond:
+                self._inflight = []
+
+    def _flush_all(self) -> None:
+        with self._cond:
+            rows, self._buffer = self._buffer, []
+        for start in range(0, len(rows), self.flush_size):
+            remaining = self._write(rows[start:start + self.flush_size])
+            if remaining:
+                self.dropped += len(remaining)
+                logger.error("❌ 終了時の履歴書き込みに失敗し %d 件を破棄しました", len(remaining))
+
+    def _write(self, rows: List[dict]) -> List[dict]:
+        """Bulk-insert ``rows``, dropping only the rows the database rejects.
+
+        A batch that fails on a constraint or data error is split in half
+        until the offending rows are isolated. Returns the rows left
+        unwritten by a connection error, which are worth retrying.
+        """
+        batches = [rows]
+        while batches:
+            batch = batches.pop()
+            try:
+                with SessionLocal() as db:
+                    db.execute(insert(ChatHistory), batch)
+                    db.commit()
+                self.flushed += len(batch)
+            except _ROW_ERRORS as e:
+                if len(batch) > 1:
+                    mid = len(batch) // 2
+                    batches += [batch[mid:], batch[:mid]]
+                    continue
+                self.dropped += 1
+                logger.error(
+                    "❌ 保存できない履歴を破棄しました (user_id=%s, character_id=%s): %s",
+                    batch[0]["user_id"], batch[0]["character_id"], str(e),
+                )
+            except Exception as e:
+                if not _is_transient(e):
+                    self.dropped += len(batch)
+                    logger.error("❌ 履歴 %d 件の書き込みに失敗し破棄しました: %s", len(batch), str(e))
+                    continue
+                logger.error("❌ 履歴の一括書き込みエラー: %s", str(e))
+                # 未処理の行を元の順序で返す
+                return batch + [r for b in reversed(batches) for r in b]
+        return []
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            "pending": len(self._buffer) + len(self._inflight),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+        }
+
+
+history_writer = HistoryWriter(
+    enabled=HISTORY_WRITE_BEHIND,
+    max_size=HISTORY_QUEUE_SIZE,
+    flush_size=HISTORY_FLUSH_SIZE,
+    flush_interval=HISTORY_FLUSH_INTERVAL,
+    full_policy=HISTORY_QUEUE_FULL_POLICY,
+    block_timeout=HISTORY_BLOCK_TIMEOUT,
+)
+
+register(Gauge("history_writer_pending", "Chat history rows waiting to be written", lambda: history_writer.stats()["pending"]))
+register(CallbackCounter("history_writer_dropped_total", "Chat history rows dropped by the write-behind buffer", lambda: history_writer.dropped))
@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from backend.db.database import SessionLocal
+from backend.models.models import IdempotencyRecord
+from backend.services.metrics import CallbackCounter, Gauge, register
+
+logger = logging.getLogger(__name__)
+
+# ✅ 設定（環境変数で調整可能）
+# 完了したレスポンスを保持する秒数
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# 処理中のまま残ったキー（ワーカー停止など）を破棄して再受付するまでの秒数
+IDEMPOTENCY_PENDING_TIMEOUT = float(os.getenv("IDEMPOTENCY_PENDING_TIMEOUT", "120"))
+# 期限切れのキーを削除する間隔（秒）
+IDEMPOTENCY_PURGE_INTERVAL = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", "600"))
+# キーなしでも同一内容の同時リクエストを1回の処理にまとめるか
+IDEMPOTENCY_COALESCE = os.getenv("IDEMPOTENCY_COALESCE", "1").lower() in ("1", "true", "yes")
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# ハンドラーの戻り値: (レスポンス本文, 保存してよいか)
+# 処理が成立しなかった場合（GPT エラーなど）は False を返し、再送で再実行させる
+Handler = Callable[[], Awaitable[Tuple[Any, bool]]]
+
+
+def request_fingerprint(payload) -> str:
+    """SHA-256 of a request model's canonical JSON."""
+    return hashlib.sha256(payload.model_dump_json().encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _Claim:
+    state: str  # "claimed" / "replay" / "pending" / "mismatch"
+    response: Any = None
+
+
+class IdempotencyStore:
+    """Replays stored responses for ``Idempotency-Key`` and coalesces duplicates.
+
+    Requests that share a key (or, with ``coalesce``, an identical body)
+    while one is in flight wait for that one and receive its result, so
+    only one LLM call runs per worker. Keyed requests also claim a row in
+    ``idempotency_keys``; the response is stored there for ``ttl`` seconds
+    and replayed to any retry, including on other workers. A retry that
+    arrives while another worker still holds the claim gets 409.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        pending_timeout: float,
+        purge_interval: float,
+        coalesce: bool = True,
+    ):
+        self.ttl = ttl
+        self.pending_timeout = pending_timeout
+        self.purge_interval = purge_interval
+        self.coalesce = coalesce
+        self._inflight: Dict[str, Tuple[str, asyncio.Future]] = {}
+        self._last_purge = 0.0
+        self.replayed = 0
+        self.coalesced = 0
+        self.conflicts = 0
+
+    async def run(
+        self,
+        endpoint: str,
+        user_id,
+        idempotency_key: Optional[str],
+        request_hash: str,
+        handler: Handler,
+    ) -> Tuple[Any, bool]:
+        """Run ``handler`` at most once per key; return ``(body, replayed)``."""
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Idempotency-Key は 1〜{IDEMPOTENCY_KEY_MAX_LENGTH} 文字で指定してください",
+            )
+        if idempotency_key is None and not self.coalesce:
+            body, _ = await handler()
+            return body, False
+
+        scope = f"{endpoint}:{user_id}:" + (
+            f"key:{idempotency_key}" if idempotency_key is not None else f"body:{request_hash}"
+        )
+        inflight = self._inflight.get(scope)
+        if inflight is not None:
+            if inflight[0] != request_hash:
+                self.conflicts += 1
+                raise self._mismatch()
+            self.coalesced += 1
+            # 待機側のキャンセルが処理本体に波及しないよう shield する
+            body = await asyncio.shield(inflight[1])
+            return body, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[scope] = (request_hash, future)
+        try:
+            if idempotency_key is not None:
+                claim = await run_in_threadpool(self._claim, scope, request_hash)
+                if claim.state == "replay":
+                    self.replayed += 1
+                    future.set_result(claim.response)
+                    return claim.response, True
+                if claim.state == "mismatch":
+                    self.conflicts += 1
+                    raise self._mismatch()
+                if claim.state == "pending":
+                    self.conflicts += 1
+                    raise HTTPException(
+                        status_code=409,
+                        detail="同じ Idempotency-Key のリクエストを処理中です",
+                        headers={"Retry-After": "1"},
+                    )
+
+            try:
+                body, completed = await handler()
+            except BaseException:
+                if idempotency_key is not None:
+                    await run_in_threadpool(self._release, scope)
+                raise
+            body = jsonable_encoder(body)
+            if idempotency_key is not None:
+                if completed:
+                    await run_in_threadpool(self._complete, scope, body)
+                else:
+                    await run_in_threadpool(self._release, scope)
+            future.set_result(body)
+            return body, False
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+                # 待機者がいない場合の "exception was never retrieved" 警告を抑止
+                future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(scope, None)
+
+    @staticmethod
+    def _mismatch() -> HTTPException:
+        return HTTPException(
+            status_code=422,
+            detail="この Idempotency-Key は別の内容のリクエストで使用されています",
+        )
+
+    def stats(self) -> dict:
+        return {
+            "ttl": self.ttl,
+            "inflight": len(self._inflight),
+            "replayed": self.replayed,
+            "coalesced": self.coalesced,
+            "conflicts": self.conflicts,
+        }
+
+    # --------------------- DB backing ---------------------
+
+    def _claim(self, scope: str, request_hash: str) -> _Claim:
+        now = datetime.now(timezone.utc)
+        self._maybe_purge(now)
+        db = SessionLocal()
+        try:
+            record = db.get(IdempotencyRecord, scope)
+            if record is not None:
+                created_at = record.created_at
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                limit = self.ttl if record.status == "done" else self.pending_timeout
+                if created_at + timedelta(seconds=limit) >= now:
+                    if record.request_hash != request_hash:
+                        return _Claim("mismatch")
+                    if record.status == "done":
+                        return _Claim("replay", record.response)
+                    return _Claim("pending")
+                # 期限切れ・放置されたキーは新しいリクエストとして受け付け直す
+                db.delete(record)
+                db.flush()
+            db.add(IdempotencyRecord(key=scope, request_hash=request_hash, status="pending", created_at=now))
+            try:
+                db.commit()
+            except IntegrityError:
+                # 他ワーカーが同時に同じキーを受け付けた
+                db.rollback()
+                return _Claim("pending")
+            return _Claim("claimed")
+        finally:
+            db.close()
+
+    def _complete(self, scope: str, body) -> None:
+        db = SessionLocal()
+        try:
+            record = db.get(IdempotencyRecord, scope)
+            if record is not None:
+                record.status = "done"
+                record.response = body
+                db.commit()
+        except SQLAlchemyError as e:
+            # 処理自体は完了しているので、保存に失敗してもレスポンスは返す
+            db.rollback()
+            logger.error("❌ Idempotency-Key の保存エラー: %s", str(e))
+        finally:
+            db.close()
+
+    def _release(self, scope: str) -> None:
+        db = SessionLocal()
+        try:
+            db.execute(delete(IdempotencyRecord).where(
+                IdempotencyRecord.key == scope, IdempotencyRecord.status == "pending"
+            ))
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            logger.warning("⚠️ Idempotency-Key の解放エラー: %s", str(e))
+        finally:
+            db.close()
+
+    def _maybe_purge(self, now: datetime) -> None:
+        if time.monotonic() - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = time.monotonic()
+        db = SessionLocal()
+        try:
+            db.execute(delete(IdempotencyRecord).where(
+                IdempotencyRecord.created_at < now - timedelta(seconds=max(self.ttl, self.pending_timeout))
+            ))
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            logger.warning("⚠️ 期限切れ Idempotency-Key の削除エラー: %s", str(e))
+        finally:
+            db.close()
+
+
+idempotency = IdempotencyStore(
+    ttl=IDEMPOTENCY_TTL,
+    pending_timeout=IDEMPOTENCY_PENDING_TIMEOUT,
+    purge_interval=IDEMPOTENCY_PURGE_INTERVAL,
+    coalesce=IDEMPOTENCY_COALESCE,
+)
+
+register(Gauge("idempotency_inflight", "Requests currently holding an idempotency slot",
+               lambda: len(idempotency._inflight)))
+register(CallbackCounter("idempotency_replayed_total", "Responses replayed for a repeated Idempotency-Key",
+               lambda: idempotency.replayed))
+register(CallbackCounter("idempotency_coalesced_total", "Duplicate requests that waited for an in-flight twin",
+               lambda: idempotency.coalesced))
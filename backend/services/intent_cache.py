@@ -0,0 +1,173 @@
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import SQLAlchemyError
+
+from backend.db.database import SessionLocal
+from backend.models.models import IntentCacheEntry
+from backend.services.metrics import CallbackCounter, register
+
+logger = logging.getLogger(__name__)
+
+# ✅ 設定（環境変数で調整可能）
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "1024"))
+INTENT_CACHE_TTL = float(os.getenv("INTENT_CACHE_TTL", "86400"))
+INTENT_CACHE_MAX_CHARS = int(os.getenv("INTENT_CACHE_MAX_CHARS", "200"))
+INTENT_CACHE_DB = os.getenv("INTENT_CACHE_DB", "").lower() in ("1", "true", "yes")
+
+
+def normalize_message(message: str) -> str:
+    """Normalize a player message into a cache key.
+
+    NFKC folds full-width/half-width variants, punctuation is dropped and
+    runs of whitespace collapse to a single space, so "こんにちは！" and
+    "こんにちは" share an entry.
+    """
+    text = unicodedata.normalize("NFKC", message).casefold()
+    folded = "".join(
+        " " if ch.isspace() else ch
+        for ch in text
+        if not unicodedata.category(ch).startswith("P")
+    )
+    key = " ".join(folded.split())
+    # 記号だけの発言（"？" など）は区別したいので元の文字列を使う
+    return key or text.strip()
+
+
+class IntentCache:
+    """Bounded LRU cache with TTL for extracted intents.
+
+    Entries live in process memory; when ``use_db`` is set, misses fall back
+    to the ``intent_cache`` table so entries survive restarts and are shared
+    between workers.
+    """
+
+    def __init__(self, max_size: int, ttl: float, use_db: bool = False, max_chars: int = 200):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_db = use_db
+        self.max_chars = max_chars
+        self._entries: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def cacheable(self, key: str) -> bool:
+        return bool(key) and len(key) <= self.max_chars
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the in-memory entry for ``key`` or ``None`` if absent/expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            intent, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return intent
+
+    def set(self, key: str, intent: str) -> None:
+        with self._lock:
+            self._entries[key] = (intent, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    async def lookup(self, message: str) -> tuple[str, Optional[str]]:
+        """Return ``(key, intent)``; ``intent`` is ``None`` on a miss."""
+        key = normalize_message(message)
+        if not self.cacheable(key):
+            self.misses += 1
+            return key, None
+
+        intent = self.get(key)
+        if intent is not None:
+            self.hits += 1
+            return key, intent
+
+        if self.use_db:
+            intent = await run_in_threadpool(self._db_get, key)
+            if intent is not None:
+                self.db_hits += 1
+                self.set(key, intent)
+                return key, intent
+
+        self.misses += 1
+        return key, None
+
+    async def store(self, key: str, intent: str) -> None:
+        if not intent or not self.cacheable(key):
+            return
+        self.set(key, intent)
+        if self.use_db:
+            await run_in_threadpool(self._db_set, key, intent)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.db_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.db_hits) / lookups if lookups else 0.0,
+        }
+
+    # --------------------- DB backing ---------------------
+
+    def _db_get(self, key: str) -> Optional[str]:
+        db = SessionLocal()
+        try:
+            entry = db.get(IntentCacheEntry, key)
+            if entry is None:
+                return None
+            created_at = entry.created_at
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            if created_at + timedelta(seconds=self.ttl) < datetime.now(timezone.utc):
+                return None
+            return entry.intent
+        except SQLAlchemyError as e:
+            logger.error("❌ 意図キャッシュ読み込みエラー: %s", str(e))
+            return None
+        finally:
+            db.close()
+
+    def _db_set(self, key: str, intent: str) -> None:
+        db = SessionLocal()
+        try:
+            db.merge(IntentCacheEntry(key=key, intent=intent, created_at=datetime.now(timezone.utc)))
+            db.commit()
+        except SQLAlchemyError as e:
+            # 他ワーカーとの同時書き込みなどは無視してよい（キャッシュなので）
+            db.rollback()
+            logger.warning("⚠️ 意図キャッシュ書き込みエラー: %s", str(e))
+        finally:
+            db.close()
+
+
+intent_cache = IntentCache(
+    max_size=INTENT_CACHE_SIZE,
+    ttl=INTENT_CACHE_TTL,
+    use_db=INTENT_CACHE_DB,
+    max_chars=INTENT_CACHE_MAX_CHARS,
+)
+
+register(CallbackCounter("intent_cache_hits_total", "Intent cache hits (memory)", lambda: intent_cache.hits))
+register(CallbackCounter("intent_cache_db_hits_total", "Intent cache hits (DB)", lambda: intent_cache.db_hits))
+register(CallbackCounter("intent_cache_misses_total", "Intent cache misses", lambda: intent_cache.misses))
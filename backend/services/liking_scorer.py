@@ -0,0 +1,146 @@
+import os
+import unicodedata
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+# ✅ 設定（環境変数で調整可能）
+LOCAL_LIKING_ENABLED = os.getenv("LOCAL_LIKING_ENABLED", "1").lower() in ("1", "true", "yes")
+# この確信度以上ならローカルで確定し、未満なら GPT 評価へ回す
+LOCAL_LIKING_CONFIDENCE = float(os.getenv("LOCAL_LIKING_CONFIDENCE", "0.85"))
+# 正規化後にこの文字数を超える発言は常に GPT 評価へ回す
+LOCAL_LIKING_MAX_CHARS = int(os.getenv("LOCAL_LIKING_MAX_CHARS", "20"))
+
+# 語尾の伸ばし・笑いなど、判定前に取り除く文字
+_TRAILING = "ーｰ〜~wｗ笑"
+
+# カタカナ → ひらがな（"ハイ" と "はい" を同一視する）
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+
+def normalize_for_scoring(message: str) -> str:
+    """Fold width/case/kana, drop punctuation, symbols, emoji and whitespace.
+
+    Trailing elongation and laughter marks ("うーん〜", "はいw") are removed
+    too, so "はい！", "ﾊｲ" and "はい〜" compare alike.
+    """
+    text = unicodedata.normalize("NFKC", message).casefold().translate(_KATAKANA_TO_HIRAGANA)
+    kept = "".join(
+        ch for ch in text
+        if not ch.isspace() and unicodedata.category(ch)[0] not in ("P", "S", "C")
+    )
+    stripped = kept.rstrip(_TRAILING)
+    return stripped or kept
+
+
+@dataclass(frozen=True)
+class LexiconEntry:
+    score: int
+    confidence: float
+    intent: str
+    reason: str
+
+
+def _entries(phrases, score: int, confidence: float, intent: str, reason: str) -> Dict[str, LexiconEntry]:
+    entry = LexiconEntry(score, confidence, intent, reason)
+    return {normalize_for_scoring(phrase): entry for phrase in phrases}
+
+
+# 🔸 既定の辞書（キーは登録時に normalize_for_scoring で正規化）
+LIKING_LEXICON: Dict[str, LexiconEntry] = {
+    **_entries(
+        ["うん", "ううん", "はい", "ええ", "そう", "そっか", "そうか", "そうだね", "そうなんだ",
+         "なるほど", "へえ", "ふーん", "ふうん", "うーん", "ok", "okay", "おk", "りょうかい",
+         "了解", "わかった", "わかりました", "yes", "no", "いいえ"],
+        0, 0.95, "相槌", "相槌のため好感度は変化しない",
+    ),
+    **_entries(
+        ["こんにちは", "こんばんは", "おはよう", "おはようございます", "やあ", "やっほ", "ハロー",
+         "hi", "hello", "よろしく", "よろしくね", "よろしくお願いします", "ただいま", "おやすみ",
+         "おやすみなさい", "またね", "じゃあね", "バイバイ", "さようなら"],
+        0, 0.9, "挨拶", "挨拶のみで好感度は変化しない",
+    ),
+    **_entries(
+        ["ありがとう", "ありがとうございます", "ありがと", "サンキュー", "thanks", "thank you",
+         "どうも", "助かった", "助かりました"],
+        1, 0.9, "感謝", "感謝を伝えられて少し嬉しい",
+    ),
+}
+
+
+@dataclass
+class LocalDecision:
+    """Outcome of the local pre-classifier for one message."""
+
+    accepted: bool
+    rule: str
+    score: int = 0
+    confidence: float = 0.0
+    intent: str = ""
+    reason: str = ""
+    matched: Optional[str] = None
+    normalized: str = ""
+    threshold: float = LOCAL_LIKING_CONFIDENCE
+
+    def as_debug(self) -> dict:
+        """Decision path for the debug output of the liking endpoints."""
+        return {
+            "decision": "local" if self.accepted else "model",
+            "rule": self.rule,
+            "matched": self.matched,
+            "normalized": self.normalized,
+            "score": self.score if self.accepted else None,
+            "confidence": self.confidence,
+            "threshold": self.threshold,
+        }
+
+
+def classify_liking(
+    message: str,
+    overrides: Optional[Dict[str, int]] = None,
+    threshold: float = LOCAL_LIKING_CONFIDENCE,
+    enabled: bool = LOCAL_LIKING_ENABLED,
+) -> LocalDecision:
+    """Score obviously trivial messages locally or defer them to the model.
+
+    Character ``overrides`` (phrase → score) are checked first and are
+    always trusted. Then empty/symbol-only messages and the built-in
+    lexicon are checked. Only exact matches on the normalized text count,
+    so anything longer or unusual is left to GPT.
+    """
+    if not enabled:
+        return LocalDecision(False, "disabled", threshold=threshold)
+
+    normalized = normalize_for_scoring(message)
+    if overrides:
+        for phrase, score in overrides.items():
+            if normalize_for_scoring(phrase) == normalized:
+                return LocalDecision(
+                    True, "override", score=int(score), confidence=1.0,
+                    intent="定型の反応", reason="キャラクター設定による評価",
+                    matched=phrase, normalized=normalized, threshold=threshold,
+                )
+
+    if not normalized:
+        return LocalDecision(
+            True, "empty", score=0, confidence=1.0, intent="記号のみ",
+            reason="内容のない発言のため好感度は変化しない",
+            normalized=normalized, threshold=threshold,
+        )
+    if len(normalized) > LOCAL_LIKING_MAX_CHARS:
+        return LocalDecision(False, "too_long", normalized=normalized, threshold=threshold)
+
+    entry = LIKING_LEXICON.get(normalized)
+    if entry is None:
+        return LocalDecision(False, "no_match", normalized=normalized, threshold=threshold)
+
+    return LocalDecision(
+        entry.confidence >= threshold,
+        "lexicon" if entry.confidence >= threshold else "below_threshold",
+        score=entry.score,
+        confidence=entry.confidence,
+        intent=entry.intent,
+        reason=entry.reason,
+        matched=normalized,
+        normalized=normalized,
+        threshold=threshold,
+    )
@@ -0,0 +1,327 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import openai
+
+from backend.services.metrics import Gauge, llm_calls, record_llm_usage, record_stage, register, stage
+from backend.services.usage_ledger import usage_ledger
+
+logger = logging.getLogger(__name__)
+
+# ✅ 設定（環境変数で調整可能）
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+# ストリーミング: 次のチャンクを待つ上限と、ストリーム全体の上限（秒）
+LLM_STREAM_CHUNK_TIMEOUT = float(os.getenv("LLM_STREAM_CHUNK_TIMEOUT", "15"))
+LLM_STREAM_TOTAL_TIMEOUT = float(os.getenv("LLM_STREAM_TOTAL_TIMEOUT", "120"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+LLM_RETRY_AFTER_MAX = float(os.getenv("LLM_RETRY_AFTER_MAX", "30"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the provider while the circuit breaker is open."""
+
+
+class FairScheduler:
+    """Concurrency limit whose waiters are served round-robin per key (user).
+
+    A user with many queued calls gets one slot per round, so a single
+    spammy player cannot starve the others.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._queues: "OrderedDict[object, deque]" = OrderedDict()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    async def acquire(self, key) -> None:
+        if self.active < self.limit and not self._queues:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠を受け取った直後にキャンセルされた場合は次の待機者へ渡す
+                self.release()
+            else:
+                queue = self._queues.get(key)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._queues[key]
+            raise
+
+    def release(self) -> None:
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not future.done():
+                # 枠をそのまま次の待機者へ引き継ぐ（active は変えない）
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failures and rejects calls for ``cooldown`` seconds."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            # クールダウン後は試行を通し（half-open）、再度失敗すれば即座に開き直す
+            self.failures = self.threshold - 1
+            self.open_until = time.monotonic() + self.cooldown
+            logger.error("❌ LLM サーキットブレーカーを %.0f 秒間開きます", self.cooldown)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS
+    return False
+
+
+class LLMGateway:
+    """Single entry point for OpenAI chat completions.
+
+    Adds a fair bounded concurrency pool, a per-attempt timeout, retries
+    with exponential backoff and jitter (honoring Retry-After) and a
+    circuit breaker, and records latency/usage metrics per call site.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        timeout: float = LLM_TIMEOUT,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE,
+        backoff_max: float = LLM_BACKOFF_MAX,
+        breaker_threshold: int = LLM_BREAKER_THRESHOLD,
+        breaker_cooldown: float = LLM_BREAKER_COOLDOWN,
+        stream_chunk_timeout: float = LLM_STREAM_CHUNK_TIMEOUT,
+        stream_total_timeout: float = LLM_STREAM_TOTAL_TIMEOUT,
+    ):
+        self.client = client
+        self.timeout = timeout
+        self.stream_chunk_timeout = stream_chunk_timeout
+        self.stream_total_timeout = stream_total_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.scheduler = FairScheduler(max_concurrency)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, LLM_RETRY_AFTER_MAX))
+        return delay
+
+    async def _create(self, call_site: str, user_id, kwargs: dict, stage_name: Optional[str] = None):
+        """Run one completion with retries; the caller holds no slot."""
+        for attempt in range(self.max_retries + 1):
+            if self.breaker.is_open:
+                llm_calls.inc(call_site=call_site, outcome="rejected")
+                raise CircuitOpenError("LLM circuit breaker is open")
+            await self.scheduler.acquire(user_id)
+            try:
+                with stage(stage_name or f"llm_{call_site}"):
+                    response = await asyncio.wait_for(
+                        self.client.chat.completions.create(**kwargs), self.timeout
+                    )
+            except asyncio.CancelledError:
+                self.scheduler.release()
+                raise
+            except Exception as e:
+                self.scheduler.release()
+                if not _is_retryable(e):
+                    llm_calls.inc(call_site=call_site, outcome="error")
+                    raise
+                if attempt == self.max_retries:
+                    # 再試行し尽くした呼び出し1回につき1回だけ失敗を数える
+                    self.breaker.record_failure()
+                    llm_calls.inc(call_site=call_site, outcome="error")
+                    raise
+                llm_calls.inc(call_site=call_site, outcome="retry")
+                delay = self._backoff(attempt, e)
+                logger.warning("⚠️ LLM 呼び出し失敗（%s）: %.2f 秒後に再試行します: %s", call_site, delay, str(e))
+                await asyncio.sleep(delay)
+                continue
+            self.breaker.record_success()
+            llm_calls.inc(call_site=call_site, outcome="ok")
+            return response
+
+    async def chat_completion(self, call_site: str, user_id=None, character_id=None, **kwargs):
+        """Create a (non-streaming) chat completion on behalf of ``user_id``."""
+        started = time.perf_counter()
+        try:
+            response = await self._create(call_site, user_id, kwargs)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            usage_ledger.record(call_site, kwargs.get("model"), user_id, character_id,
+                                latency=time.perf_counter() - started, outcome="error")
+            raise
+        self.scheduler.release()
+        record_llm_usage(call_site, response)
+        usage_ledger.record(call_site, kwargs.get("model"), user_id, character_id,
+                            getattr(response, "usage", None), time.perf_counter() - started)
+        return response
+
+    @asynccontextmanager
+    async def stream_chat_completion(self, call_site: str, user_id=None, character_id=None, **kwargs):
+        """Open a streaming completion; the concurrency slot is held until the block exits.
+
+        Retries and ``timeout`` apply to opening the stream (time to first
+        byte). Reading is bounded by ``stream_chunk_timeout`` per chunk and
+        ``stream_total_timeout`` overall; on expiry ``asyncio.TimeoutError``
+        is raised, the upstream stream is closed and the slot released.
+        Usage is taken from the final chunk (``stream_options.include_usage``)
+        when the block exits.
+        """
+        started = time.perf_counter()
+        try:
+            # 開始までの待ち（最初の応答）と、読み終わるまでの全体を別の段階として計測する
+            stream = await self._create(call_site, user_id, {**kwargs, "stream": True}, f"llm_{call_site}_ttfb")
+        except CircuitOpenError:
+            raise
+        except Exception:
+            usage_ledger.record(call_site, kwargs.get("model"), user_id, character_id,
+                                latency=time.perf_counter() - started, outcome="error")
+            raise
+        tracked = _UsageTrackingStream(
+            stream, self.stream_chunk_timeout, time.monotonic() + self.stream_total_timeout
+        )
+        outcome = "ok"
+        try:
+            yield tracked
+        except asyncio.TimeoutError:
+            outcome = "error"
+            self.breaker.record_failure()
+            llm_calls.inc(call_site=call_site, outcome="stream_timeout")
+            logger.warning("⚠️ LLM ストリームが応答しないため打ち切りました（%s）", call_site)
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            self.scheduler.release()
+            await tracked.close()
+            record_stage(f"llm_{call_site}", time.perf_counter() - started)
+            record_llm_usage(call_site, tracked.usage)
+            usage_ledger.record(call_site, kwargs.get("model"), user_id, character_id,
+                                tracked.usage, time.perf_counter() - started, outcome)
+
+
+class _UsageTrackingStream:
+    """Passes stream chunks through, keeps the last ``usage`` seen and bounds each read."""
+
+    def __init__(self, stream, chunk_timeout: float, deadline: float):
+        self._stream = stream
+        self._chunk_timeout = chunk_timeout
+        self._deadline = deadline
+        self.usage = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError("LLM stream exceeded its total timeout")
+        chunk = await asyncio.wait_for(self._stream.__anext__(), min(self._chunk_timeout, remaining))
+        if getattr(chunk, "usage", None):
+            self.usage = chunk.usage
+        return chunk
+
+    async def close(self) -> None:
+        """Close the upstream stream (frees the HTTP connection after a timeout or early exit)."""
+        close = getattr(self._stream, "close", None) or getattr(self._stream, "aclose", None)
+        if close is None:
+            return
+        try:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logger.warning("⚠️ LLM ストリームのクローズに失敗しました: %s", str(e))
+
+
+# 計測対象のゲートウェイ（create_gateway のたびに差し替え）
+_current: Optional[LLMGateway] = None
+
+register(Gauge("llm_inflight", "OpenAI calls currently holding a slot",
+               lambda: _current.scheduler.active if _current else 0))
+register(Gauge("llm_queued", "OpenAI calls waiting for a slot",
+               lambda: _current.scheduler.queued if _current else 0))
+register(Gauge("llm_circuit_open", "1 while the LLM circuit breaker is open",
+               lambda: int(_current.breaker.is_open) if _current else 0))
+
+
+def create_gateway(client) -> LLMGateway:
+    global _current
+    _current = LLMGateway(client)
+    return _current
@@ -0,0 +1,142 @@
+import threading
+from typing import Optional
+
+from backend.services.metrics import stage
+
+# 好感度レベルごとの応答指示
+LIKING_LEVEL_PROMPTS = {
+    0: "相手を嫌っているように、冷たく、感情を抑えて応答してください。",
+    1: "相手に警戒しつつ、距離を取りつつ応答してください。",
+    2: "",  # 中立
+    3: "相手に少し好意を持ち、優しく応答してください。",
+    4: "非常に親しい相手として、親しみを込めて応答してください。"
+}
+
+# プロンプトの静的部分に影響するキャラクター属性
+_CHARACTER_PROMPT_FIELDS = (
+    "name",
+    "openness",
+    "conscientiousness",
+    "extraversion",
+    "agreeableness",
+    "neuroticism",
+    "background",
+    "world",
+    "tone",
+    "prohibited",
+    "examples",
+)
+
+
+# map_liking_to_level が区別する好感度の範囲（これを超えてもレベルは変わらない）
+LIKING_MIN = -5
+LIKING_MAX = 5
+
+
+def map_liking_to_level(liking: int) -> int:
+    """Convert raw liking value to a discrete level."""
+    if liking <= -5:
+        return 0
+    elif liking <= -2:
+        return 1
+    elif liking <= 1:
+        return 2
+    elif liking <= 4:
+        return 3
+    else:
+        return 4
+
+
+def compile_character_prompt(character) -> str:
+    """Render the static, per-character part of the system prompt.
+
+    Everything up to the 【価値軸】 header depends only on the character, so
+    it is kept as a byte-identical prefix across turns.
+    """
+    prohibited = character.prohibited
+    examples = character.examples
+    prohibited_text = "\n".join(f"- {item}" for item in prohibited) if prohibited else "なし"
+    examples_text = "\n".join(
+        f"ユーザー: {ex['user']}\nキャラ: {ex['assistant']}"
+        for ex in examples
+    ) if examples else "なし"
+
+    return f"""あなたは「{character.name}」というキャラクターとして対話を行います。
+
+このキャラクターの性格は Big Five モデルに基づき、以下の通り数値で表されています。
+スコアは 0.0（非常に低い）〜 1.0（非常に高い）の範囲です。
+
+- Openness: {character.openness}
+- Conscientiousness: {character.conscientiousness}
+- Extraversion: {character.extraversion}
+- Agreeableness: {character.agreeableness}
+- Neuroticism: {character.neuroticism}
+
+これらの性格特性に基づき、発言内容・話し方・反応を自然に調整してください。
+
+【背景】
+{character.background}
+
+【世界観】
+{character.world}
+
+【口調】
+{character.tone}
+
+【禁止事項】
+{prohibited_text}
+
+【会話例】
+{examples_text}
+
+【価値軸】
+"""
+
+
+class CompiledPromptCache:
+    """Compiled static prompt sections keyed by character id.
+
+    Each entry remembers the attribute values it was compiled from, so a
+    character edited by another worker is recompiled on next use even
+    without an explicit ``invalidate``.
+    """
+
+    def __init__(self):
+        self._entries: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, character) -> str:
+        source = tuple(getattr(character, f) for f in _CHARACTER_PROMPT_FIELDS)
+        entry = self._entries.get(character.id)
+        if entry is not None and entry[0] == source:
+            return entry[1]
+        compiled = compile_character_prompt(character)
+        with self._lock:
+            self._entries[character.id] = (source, compiled)
+        return compiled
+
+    def invalidate(self, character_id=None) -> None:
+        """Drop one character's compiled prompt, or all of them."""
+        with self._lock:
+            if character_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(character_id, None)
+
+
+prompt_cache = CompiledPromptCache()
+
+
+def format_construct(c) -> str:
+    axis = c.axis
+    pair = f"{axis[0]} ↔ {axis[1]}" if len(axis) == 2 else ",".join(axis)
+    return f"- {c.name} ({pair}) = {c.value} / importance {c.importance}\n  {c.behavior_effect}"
+
+
+def build_full_prompt(character, liking_level: int, constructs=None, intent: Optional[str] = None) -> str:
+    """Assemble the system prompt: cached character prefix, then per-turn parts."""
+    with stage("prompt_build"):
+        constructs_text = "\n".join(format_construct(c) for c in constructs) if constructs else "なし"
+        liking_text = LIKING_LEVEL_PROMPTS.get(liking_level, "")
+        intent_text = f"\n【ユーザーの意図】\n{intent}" if intent else ""
+        return f"{prompt_cache.get(character)}{constructs_text}\n\n{liking_text}{intent_text}\n"
@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+from typing import Optional, Set
+from uuid import UUID
+
+from backend.schemas.schemas import CharacterResponse
+from backend.services.context import SUMMARY_REFRESH_MESSAGES, ConversationContext
+from backend.services.metrics import Gauge, register
+
+
+@dataclass(eq=False)
+class ConversationSession:
+    """Hot state of one WebSocket conversation (user × character).
+
+    Character, liking, constructs and the context window are loaded once
+    on connect and updated in memory after each turn; every turn is also
+    written through to the database, so a reconnect starts from the same
+    state.
+    """
+
+    user_id: UUID
+    character_id: UUID
+    character: CharacterResponse
+    liking: int
+    constructs: list
+    context: ConversationContext
+    turns: int = 0
+    # 接続後にコンテキストウィンドウから外れた発言数（要約の更新判定に使用）
+    dropped: int = 0
+
+    def record_turn(self, user_message: str, reply: str, new_liking: Optional[int]) -> None:
+        """Apply a persisted turn to the in-memory state."""
+        if new_liking is not None:
+            self.liking = new_liking
+        self.dropped += self.context.append_turn(user_message, reply)
+        self.turns += 1
+
+    def reload(self, fresh: "ConversationSession") -> None:
+        """Replace the hot state with a freshly loaded copy."""
+        self.character = fresh.character
+        self.liking = fresh.liking
+        self.constructs = fresh.constructs
+        self.context = fresh.context
+        self.dropped = 0
+
+    def ready_event(self) -> dict:
+        return {
+            "type": "ready",
+            "character": {"id": str(self.character.id), "name": self.character.name},
+            "liking": self.liking,
+            "messages": len(self.context.messages),
+        }
+
+    @property
+    def needs_resync(self) -> bool:
+        """True once enough turns left the window to warrant a summary refresh."""
+        return self.dropped >= SUMMARY_REFRESH_MESSAGES
+
+
+class SessionRegistry:
+    """Counts the WebSocket sessions open in this worker."""
+
+    def __init__(self):
+        self._sessions: Set[ConversationSession] = set()
+
+    def add(self, session: ConversationSession) -> None:
+        self._sessions.add(session)
+
+    def discard(self, session: ConversationSession) -> None:
+        self._sessions.discard(session)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+sessions = SessionRegistry()
+
+register(Gauge("ws_sessions", "Open WebSocket conversation sessions", lambda: len(sessions)))
@@ -0,0 +1,278 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+
+from backend.crud.crud import add_usage_rollups
+from backend.db.database import SessionLocal
+from backend.models.models import LLMUsage
+from backend.services.metrics import CallbackCounter, Gauge, register
+
+logger = logging.getLogger(__name__)
+
+# ✅ 設定（環境変数で調整可能）
+USAGE_LEDGER = os.getenv("USAGE_LEDGER", "1").lower() in ("1", "true", "yes")
+USAGE_QUEUE_SIZE = int(os.getenv("USAGE_QUEUE_SIZE", "20000"))
+USAGE_FLUSH_SIZE = int(os.getenv("USAGE_FLUSH_SIZE", "500"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "2.0"))
+# モデル名の接頭辞ごとの料金（USD / 100万トークン、[入力, 出力]）
+USAGE_PRICES: Dict[str, Tuple[float, float]] = {
+    model: tuple(prices)
+    for model, prices in json.loads(
+        os.getenv("USAGE_PRICES", '{"gpt-4o": [2.5, 10.0], "gpt-4o-mini": [0.15, 0.6]}')
+    ).items()
+}
+
+# 集計テーブルで「対象なし」を表すキー（Max UUID。ゼロ UUID は SQLite で数値 0 に変換されるため）
+NO_ID = uuid.UUID(int=(1 << 128) - 1)
+
+# 集計 API の group_by に指定できる名前（hour/day は時系列）
+USAGE_GROUPS = ("user", "character", "call_site", "model", "hour", "day")
+USAGE_DEFAULT_WINDOW = timedelta(hours=24)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    """USD cost from ``USAGE_PRICES`` (longest matching model prefix), or None if unpriced."""
+    matches = [prefix for prefix in USAGE_PRICES if model.startswith(prefix)]
+    if not matches:
+        return None
+    prompt_price, completion_price = USAGE_PRICES[max(matches, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+def usage_window(since: Optional[datetime], until: Optional[datetime]) -> Tuple[datetime, datetime]:
+    """Resolve a query window to whole UTC hours (the rollup granularity).
+
+    Naive datetimes are taken as UTC; ``until`` defaults to now and
+    ``since`` to ``USAGE_DEFAULT_WINDOW`` before ``until``.
+    """
+    def utc(value: datetime) -> datetime:
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+    until = utc(until) if until else datetime.now(timezone.utc)
+    since = utc(since) if since else until - USAGE_DEFAULT_WINDOW
+    end = _hour(until)
+    if end < until:
+        end += timedelta(hours=1)
+    return _hour(since), end
+
+
+def summarize_usage(rows: List[dict], group_by: List[str]) -> List[dict]:
+    """Price per-model rows from ``aggregate_usage`` and merge them by ``group_by``.
+
+    ``cost_usd`` is None when any contributing model has no price.
+    """
+    merged: Dict[tuple, dict] = {}
+    for r in rows:
+        key = tuple(r[name] for name in group_by)
+        total = merged.get(key)
+        if total is None:
+            total = merged[key] = {
+                **{name: _key_value(r[name]) for name in group_by},
+                "calls": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "latency_ms": 0.0, "cost_usd": 0.0,
+            }
+        for name in ("calls", "errors", "prompt_tokens", "completion_tokens", "latency_ms"):
+            total[name] += r[name] or 0
+        cost = estimate_cost(r["model"], r["prompt_tokens"] or 0, r["completion_tokens"] or 0)
+        total["cost_usd"] = None if cost is None or total["cost_usd"] is None else total["cost_usd"] + cost
+
+    results = []
+    for total in merged.values():
+        latency = total.pop("latency_ms")
+        total["total_tokens"] = total["prompt_tokens"] + total["completion_tokens"]
+        total["avg_latency_ms"] = round(latency / total["calls"], 1) if total["calls"] else None
+        if total["cost_usd"] is not None:
+            total["cost_usd"] = round(total["cost_usd"], 6)
+        results.append(total)
+    if "hour" in group_by or "day" in group_by:
+        results.sort(key=lambda t: [t[name] or "" for name in group_by if name in ("hour", "day")])
+    else:
+        results.sort(key=lambda t: t["total_tokens"], reverse=True)
+    return results
+
+
+def _key_value(value):
+    """JSON-friendly group key (``NO_ID`` → None, datetimes as ISO strings)."""
+    if value == NO_ID:
+        return None
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _hour(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup_rows(rows: List[dict]) -> List[dict]:
+    """Fold ledger rows into per-hour totals keyed like ``llm_usage_hourly``."""
+    totals: Dict[tuple, dict] = {}
+    for r in rows:
+        key = (
+            _hour(r["created_at"]),
+            r["user_id"] or NO_ID,
+            r["character_id"] or NO_ID,
+            r["call_site"],
+            r["model"],
+        )
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = {
+                "id": uuid.uuid4(),
+                "bucket": key[0],
+                "user_id": key[1],
+                "character_id": key[2],
+                "call_site": key[3],
+                "model": key[4],
+                "calls": 0,
+                "errors": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "latency_ms": 0.0,
+            }
+        total["calls"] += 1
+        total["errors"] += r["outcome"] != "ok"
+        total["prompt_tokens"] += r["prompt_tokens"]
+        total["completion_tokens"] += r["completion_tokens"]
+        total["latency_ms"] += r["latency_ms"]
+    return list(totals.values())
+
+
+class UsageLedger:
+    """Buffers one row per OpenAI call and writes them off the request path.
+
+    A background thread inserts the buffered rows into ``llm_usage`` and
+    adds them to the ``llm_usage_hourly`` rollup in the same transaction,
+    every ``flush_interval`` seconds or once ``flush_size`` rows are
+    pending. ``record`` never blocks; when the buffer is full the row is
+    dropped and counted.
+    """
+
+    def __init__(self, enabled: bool, max_size: int, flush_size: int, flush_interval: float):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer: List[dict] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.flushed = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if not self.enabled or self.running:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the flusher and write everything still buffered."""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+        with self._cond:
+            rows, self._buffer = self._buffer, []
+        for start in range(0, len(rows), self.flush_size):
+            self._flush(rows[start:start + self.flush_size], requeue=False)
+
+    def record(
+        self,
+        call_site: str,
+        model: Optional[str],
+        user_id=None,
+        character_id=None,
+        usage=None,
+        latency: float = 0.0,
+        outcome: str = "ok",
+    ) -> None:
+        """Queue one call; ``usage`` is the OpenAI usage object (or None)."""
+        if not self.running:
+            return
+        row = {
+            "created_at": datetime.now(timezone.utc),
+            "user_id": user_id,
+            "character_id": character_id,
+            "call_site": call_site,
+            "model": model or "unknown",
+            "prompt_tokens": (getattr(usage, "prompt_tokens", 0) or 0) if usage else 0,
+            "completion_tokens": (getattr(usage, "completion_tokens", 0) or 0) if usage else 0,
+            "latency_ms": latency * 1000,
+            "outcome": outcome,
+        }
+        with self._cond:
+            if len(self._buffer) >= self.max_size:
+                self.dropped += 1
+                return
+            self._buffer.append(row)
+            if len(self._buffer) >= self.flush_size:
+                self._cond.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._buffer) < self.flush_size:
+                    self._cond.wait(self.flush_interval)
+                if self._stopping:
+                    return
+                if not self._buffer:
+                    continue
+                rows = self._buffer[:self.flush_size]
+                self._buffer = self._buffer[self.flush_size:]
+            self._flush(rows)
+
+    def _flush(self, rows: List[dict], requeue: bool = True) -> None:
+        try:
+            with SessionLocal() as db:
+                db.execute(insert(LLMUsage), rows)
+                add_usage_rollups(db, rollup_rows(rows))
+                db.commit()
+            self.flushed += len(rows)
+        except Exception as e:
+            logger.error("❌ トークン使用量の書き込みエラー: %s", str(e))
+            if not requeue:
+                self.dropped += len(rows)
+                return
+            with self._cond:
+                room = max(self.max_size - len(self._buffer), 0)
+                self._buffer = rows[:room] + self._buffer
+                self.dropped += max(len(rows) - room, 0)
+            time.sleep(self.flush_interval)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            "pending": len(self._buffer),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+        }
+
+
+usage_ledger = UsageLedger(
+    enabled=USAGE_LEDGER,
+    max_size=USAGE_QUEUE_SIZE,
+    flush_size=USAGE_FLUSH_SIZE,
+    flush_interval=USAGE_FLUSH_INTERVAL,
+)
+
+register(Gauge("usage_ledger_pending", "LLM usage rows waiting to be written", lambda: len(usage_ledger._buffer)))
+register(CallbackCounter("usage_ledger_dropped_total", "LLM usage rows dropped by the ledger buffer", lambda: usage_ledger.dropped))
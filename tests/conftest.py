@@ -0,0 +1,40 @@
+import os
+import uuid
+
+import pytest
+from sqlalchemy import event
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from backend.db.database import SessionLocal, dispose_engine, init_engine  # noqa: E402
+from backend.models.models import Base, Character, User  # noqa: E402
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'test.db'}"
+
+
+@pytest.fixture
+def engine(database_url):
+    """Process-wide engine on a fresh SQLite file with foreign keys enforced."""
+    dispose_engine()
+    engine = init_engine(database_url)
+
+    @event.listens_for(engine, "connect")
+    def _enable_foreign_keys(dbapi_connection, _):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    dispose_engine()
+
+
+@pytest.fixture
+def user_and_character(engine):
+    with SessionLocal() as db:
+        user = User(id=uuid.uuid4(), username="player")
+        character = Character(id=uuid.uuid4(), name="A", personality="calm", system_prompt="x")
+        db.add_all([user, character])
+        db.commit()
+        return user.id, character.id
@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta, timezone
+
+from backend.crud.crud import get_chat_history_page
+from backend.db.database import SessionLocal
+from backend.models.models import ChatHistory
+from backend.services.history_writer import make_history_row
+
+
+def test_before_cursor_walks_every_page(user_and_character):
+    user_id, character_id = user_and_character
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(7):
+        row = make_history_row(user_id, character_id, "user", f"message {i}")
+        # 同じ時刻の行を含めて、id による並びの継続も確認する
+        row["timestamp"] = base + timedelta(seconds=i // 2)
+        rows.append(row)
+    with SessionLocal() as db:
+        db.add_all(ChatHistory(**row) for row in rows)
+        db.commit()
+
+    seen, cursor = [], None
+    with SessionLocal() as db:
+        while True:
+            page, cursor = get_chat_history_page(db, user_id, character_id, limit=3, before=cursor)
+            seen = [r.id for r in page] + seen
+            if cursor is None:
+                break
+
+    expected = sorted(rows, key=lambda r: (r["timestamp"], str(r["id"])))
+    assert seen == [r["id"] for r in expected]
@@ -0,0 +1,48 @@
+import time
+import uuid
+
+from sqlalchemy import func, select
+
+from backend.db.database import SessionLocal
+from backend.models.models import ChatHistory
+from backend.services.history_writer import HistoryWriter, make_history_row
+
+
+def _mixed_rows(user_id, character_id):
+    rows = [make_history_row(user_id, character_id, "user", f"message {i}") for i in range(5)]
+    # 存在しないユーザーの行（外部キー違反）を途中に混ぜる
+    rows.insert(2, make_history_row(uuid.uuid4(), character_id, "user", "orphan"))
+    return rows
+
+
+def _stored_messages():
+    with SessionLocal() as db:
+        return db.scalars(select(ChatHistory.message).order_by(ChatHistory.message)).all()
+
+
+def test_bad_row_is_dropped_without_blocking_the_batch(user_and_character):
+    writer = HistoryWriter(enabled=True, max_size=100, flush_size=10, flush_interval=0.05)
+    writer.start()
+    try:
+        assert writer.enqueue(_mixed_rows(*user_and_character))
+        deadline = time.monotonic() + 5
+        while writer.stats()["pending"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert writer.stats()["pending"] == 0
+    finally:
+        writer.stop()
+
+    assert (writer.flushed, writer.dropped) == (5, 1)
+    assert _stored_messages() == [f"message {i}" for i in range(5)]
+
+
+def test_shutdown_flush_keeps_good_rows(user_and_character):
+    # 定期フラッシュが走らない設定にして、終了時の書き出しだけを通す
+    writer = HistoryWriter(enabled=True, max_size=100, flush_size=50, flush_interval=60)
+    writer.start()
+    assert writer.enqueue(_mixed_rows(*user_and_character))
+    writer.stop()
+
+    assert (writer.flushed, writer.dropped) == (5, 1)
+    with SessionLocal() as db:
+        assert db.scalar(select(func.count()).select_from(ChatHistory)) == 5
@@ -0,0 +1,33 @@
+import types
+
+import pytest
+from fastapi.testclient import TestClient
+
+from backend.main import create_app
+
+
+class _UnusedCompletions:
+    async def create(self, **kwargs):
+        raise AssertionError("locally scored messages must not call GPT")
+
+
+@pytest.fixture
+def client(database_url, user_and_character):
+    # 起動時にキャラクター一覧を読み込むため、行を入れてからアプリを起動する
+    openai_client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=_UnusedCompletions()))
+    with TestClient(create_app(openai_client=openai_client, database_url=database_url)) as client:
+        yield client
+
+
+def test_local_scorer_omits_prompt(client, user_and_character):
+    user_id, character_id = user_and_character
+    response = client.post("/evaluate-liking", json={
+        "user_id": str(user_id),
+        "character_id": str(character_id),
+        "player_message": "ありがとう",
+        "include_prompt": True,
+    })
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert "prompt" not in body
+    assert body["scorer"]["decision"] == "local"
@@ -0,0 +1,8 @@
+from backend.services.metrics import CallbackCounter, Gauge
+
+
+def test_callback_counter_renders_as_counter():
+    hits = {"value": 3}
+    lines = CallbackCounter("cache_hits_total", "Cache hits", lambda: hits["value"]).render()
+    assert lines == ["# HELP cache_hits_total Cache hits", "# TYPE cache_hits_total counter", "cache_hits_total 3"]
+    assert Gauge("queued", "Queued", lambda: 1).render()[1] == "# TYPE queued gauge"
@@ -10,6 +10,7 @@ public class ChatHistoryLoader : MonoBehaviour
     public string historyUrl;
     public string userId = "1f494426-588c-4a74-a5a0-6d9d1dafebec";
     public string characterId = "854d5e61-9d5c-45c6-b3b6-019acfba777e";
+    public int pageSize = 50;              // 最新から取得する件数
 
     [Header("プレハブ")]
     public GameObject leftMessagePrefab;   // キャラ用
@@ -34,7 +35,8 @@ public class ChatHistoryLoader : MonoBehaviour
 
     void Awake()
     {
-        historyUrl = ApiConfig.BaseUrl + "/history/{0}/{1}";
+        // 最新 pageSize 件のみ取得（古いページはレスポンスヘッダ X-Next-Before を before に渡す）
+        historyUrl = ApiConfig.BaseUrl + "/history/{0}/{1}?limit={2}";
     }
 
     void Start()
@@ -44,7 +46,7 @@ public class ChatHistoryLoader : MonoBehaviour
 
     IEnumerator LoadHistory()
     {
-        string url = string.Format(historyUrl, userId, characterId);
+        string url = string.Format(historyUrl, userId, characterId, pageSize);
         UnityWebRequest request = UnityWebRequest.Get(url);
         yield return request.SendWebRequest();
 
@@ -32,7 +32,8 @@ public class ChatManager : MonoBehaviour
 
     void Awake()
     {
-        apiUrl = ApiConfig.BaseUrl + "/chat";
+        // 返答生成と好感度評価を1リクエストで行う /turn を使用
+        apiUrl = ApiConfig.BaseUrl + "/turn";
     }
 
     void Start()
@@ -61,6 +62,7 @@ public class ChatManager : MonoBehaviour
         };
 
         string jsonData = JsonUtility.ToJson(payload);
+        string idempotencyKey = System.Guid.NewGuid().ToString();
 
         Debug.Log("📤 Chat送信JSON: " + jsonData);
 
@@ -70,23 +72,19 @@ public class ChatManager : MonoBehaviour
             request.uploadHandler = new UploadHandlerRaw(bodyRaw);
             request.downloadHandler = new DownloadHandlerBuffer();
             request.SetRequestHeader("Content-Type", "application/json");
+            // 再送時に二重処理されないよう、メッセージごとに一意なキーを付ける
+            request.SetRequestHeader("Idempotency-Key", idempotencyKey);
 
             yield return request.SendWebRequest();
 
             if (request.result == UnityWebRequest.Result.Success)
             {
                 string responseJson = request.downloadHandler.text;
-                ChatResponse response = JsonUtility.FromJson<ChatResponse>(responseJson);
+                TurnResponse response = JsonUtility.FromJson<TurnResponse>(responseJson);
                 responseText.text = response.reply;
 
-                if (trustEvaluator != null)
-                {
-                    trustEvaluator.EvaluateTrust(message);  // ← 評価実行
-                }
-                else
-                {
-                    Debug.LogWarning("⚠️ TrustEvaluator が未アサインです");
-                }
+                // /turn は好感度評価も済ませて返すため、TrustEvaluator を別途呼ぶ必要はない
+                SetTrust(response.new_liking);
             }
             else
             {
@@ -117,3 +115,13 @@ public class ChatResponse
 {
     public string reply;
 }
+
+// /turn の返答JSON形式（返答＋好感度評価）
+[System.Serializable]
+public class TurnResponse
+{
+    public string reply;
+    public int score;
+    public string reason;
+    public int new_liking;
+}
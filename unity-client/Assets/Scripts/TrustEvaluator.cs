@@ -75,6 +75,7 @@ public class TrustEvaluator : MonoBehaviour
         };
 
         string json = JsonUtility.ToJson(payload);
+        string idempotencyKey = System.Guid.NewGuid().ToString();
 
         Debug.Log("📤 送信するJSON: " + json);
 
@@ -83,6 +84,8 @@ public class TrustEvaluator : MonoBehaviour
         request.uploadHandler = new UploadHandlerRaw(bodyRaw);
         request.downloadHandler = new DownloadHandlerBuffer();
         request.SetRequestHeader("Content-Type", "application/json");
+        // 再送時に二重処理されないよう、メッセージごとに一意なキーを付ける
+        request.SetRequestHeader("Idempotency-Key", idempotencyKey);
 
         yield return request.SendWebRequest();
 